@@ -0,0 +1,391 @@
+"""benchmark.py: Launch the NFE and a set of virtual routers, measure convergence."""
+
+import os
+import sys
+import json
+import time
+import heapq
+import struct
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+from nfe import Topology, LINK_CONTROL
+from virtualrouter import VirtualRouter
+from distancevector import DistanceVectorRouter
+from simulation import SimulatedNetwork, SimulatedRouter, SimulatedDistanceVectorRouter
+
+NFE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nfe.py')
+
+# Routing engines: name -> (router class with sockets, router class for the simulation)
+ENGINES = {
+    'ls': (VirtualRouter, SimulatedRouter),
+    'dv': (DistanceVectorRouter, SimulatedDistanceVectorRouter),
+}
+
+
+# Load and validate a topology file the same way the NFE does
+def load_topology(path):
+    with open(path) as fd:
+        return Topology(json.load(fd, object_pairs_hook=Topology.dup_key_verify))
+
+
+# Adjacency of the topology: router id -> {neighbour id: link cost}
+def topology_graph(topology):
+    graph = {}
+    for router in topology.routers:
+        graph[router.id] = {neighbour.id: neighbour.link.cost for neighbour in router.neighbours}
+    return graph
+
+
+# Shortest path costs from source to every router
+def shortest_costs(graph, source):
+    cost = {source: 0}
+    pq = [(0, source)]
+    while pq:
+        current_cost, u = heapq.heappop(pq)
+        if current_cost > cost[u]:
+            continue
+        for v, link_cost in graph[u].items():
+            new_cost = current_cost + link_cost
+            if new_cost < cost.get(v, float('inf')):
+                cost[v] = new_cost
+                heapq.heappush(pq, (new_cost, v))
+    return cost
+
+
+# Reference SPF: router id -> {router id: cost}
+def reference_costs(graph):
+    return {source: shortest_costs(graph, source) for source in graph}
+
+
+# A routing table agrees with the reference if every destination has the optimal cost
+# and its next hops are exactly the neighbours that start one of the shortest paths
+def table_converged(router_id, routing_table, graph, reference):
+    costs = reference[router_id]
+    if len(routing_table) != len(costs) - 1:
+        return False
+    for target, (cost, next_hops) in routing_table.items():
+        if cost != costs.get(target):
+            return False
+        expected = [neighbour for neighbour, link_cost in graph[router_id].items() if link_cost + reference[neighbour].get(target, float('inf')) == cost]
+        if sorted(expected) != list(next_hops):
+            return False
+    return True
+
+
+# With areas, routes into other areas go through area border routers and can cost more than the shortest path.
+# Routing tables are correct when following the next hops of every router reaches every other router without a loop,
+# and they have no route to a router that doesn't exist; returns the routers whose table gets everywhere.
+# tables: router id -> routing table
+def tables_delivering(tables):
+    delivering = {u for u, table in tables.items() if all(target in tables for target in table)}
+    for target in tables:
+        # router -> True if all of its next hops toward target get there, None while being followed
+        reaches = {target: True}
+
+        def follow(u):
+            if u in reaches:
+                return reaches[u] is True
+            reaches[u] = None
+            entry = tables[u].get(target)
+            reaches[u] = entry is not None and all(hop in tables and follow(hop) for hop in entry[1])
+            return reaches[u]
+
+        for u in tables:
+            if not follow(u):
+                delivering.discard(u)
+    return delivering
+
+
+# Pick a free UDP port on the loopback interface for the NFE
+def free_port():
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Start the NFE and wait until it's accepting init messages
+def start_nfe(topology_path, port, workdir, nfe_args=(), timeout=30):
+    log_path = os.path.join(workdir, 'nfe.out')
+    log = open(log_path, 'w')
+    nfe = subprocess.Popen([sys.executable, NFE_PATH, '127.0.0.1', str(port), os.path.abspath(topology_path)] + list(nfe_args),
+                           cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with open(log_path) as fd:
+            if 'waiting for init' in fd.read():
+                return nfe
+        if nfe.poll() is not None:
+            raise Exception("NFE exited early, see {}".format(log_path))
+        time.sleep(0.05)
+    nfe.kill()
+    raise Exception("NFE did not start within {} seconds".format(timeout))
+
+
+# Link id -> (router id, router id)
+def link_endpoints(topology):
+    endpoints = {}
+    for router in topology.routers:
+        for neighbour in router.neighbours:
+            endpoints[neighbour.link.id] = (router.id, neighbour.id)
+    return endpoints
+
+
+# Parse LINK:COST, COST being a number, 'down', or 'up' for the cost in the topology file
+def parse_link_event(text, topology):
+    link_id, _, cost = text.partition(':')
+    link_id = int(link_id)
+    original_costs = {link.id: link.cost for link in topology.links}
+    if link_id not in original_costs:
+        raise ValueError("link {} is not in the topology".format(link_id))
+    if cost == 'down':
+        return link_id, -1
+    if cost == 'up':
+        return link_id, original_costs[link_id]
+    return link_id, int(cost)
+
+
+# The expected state before and after every link event: [(label, (link id, cost) or None, graph, reference)];
+# the reference is None with areas, the tables are checked with tables_delivering instead
+def build_phases(topology, link_events):
+    graph = topology_graph(topology)
+    references = (lambda graph: None) if topology.has_areas else reference_costs
+    phases = [('initial', None, graph, references(graph))]
+    endpoints = link_endpoints(topology)
+    for link_id, cost in link_events:
+        u, v = endpoints[link_id]
+        graph = {router_id: dict(neighbours) for router_id, neighbours in graph.items()}
+        if cost < 0:
+            graph[u].pop(v, None)
+            graph[v].pop(u, None)
+            label = 'link {} down'.format(link_id)
+        else:
+            graph[u][v] = graph[v][u] = cost
+            label = 'link {} cost {}'.format(link_id, cost)
+        phases.append((label, (link_id, cost), graph, references(graph)))
+    return phases
+
+
+# Run every router on its own thread in this process, each with its own socket to the NFE;
+# with stop, the routers are stopped before returning so that another set can run after them
+def run_threads(topology, port, phases, timeout, poll_interval, router_options={}, router_class=VirtualRouter, stop=False):
+    routers = [router_class('127.0.0.1', port, router.id, **router_options) for router in topology.routers]
+
+    def run(vr):
+        vr.init()
+        vr.forward()
+
+    threads = [threading.Thread(target=run, args=(vr,), daemon=True) for vr in routers]
+    for thread in threads:
+        thread.start()
+
+    control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    results = []
+    for label, event, graph, reference in phases:
+        if event is not None:
+            control.sendto(struct.pack("!iii", LINK_CONTROL, *event), ('127.0.0.1', port))
+        start = time.time()
+        converged_at = None
+        while time.time() - start < timeout:
+            if count_converged(routers, graph, reference) == len(routers):
+                converged_at = time.time() - start
+                break
+            time.sleep(poll_interval)
+        results.append((label, converged_at))
+        if converged_at is None:
+            break
+
+    if stop:
+        # forward() returns at its next turn, within flush_interval seconds
+        for vr in routers:
+            vr.timeout = 0
+        for thread in threads:
+            thread.join(timeout)
+    return results, routers
+
+
+# Run every router as a task on one asyncio loop, relayed by an in-memory NFE
+def run_simulation(topology, phases, timeout, poll_interval, latency=0.0, loss=0.0, router_options={}, router_class=SimulatedRouter):
+
+    async def simulate():
+        loop = asyncio.get_event_loop()
+        network = SimulatedNetwork(topology, latency, loss)
+        routers = {router.id: router_class(network, router.id, **router_options) for router in topology.routers}
+        tasks = [asyncio.ensure_future(vr.run()) for vr in routers.values()]
+
+        results = []
+        for label, event, graph, reference in phases:
+            if event is not None:
+                network.control(*event)
+                # the expected tables changed, every router has to be checked again
+                network.dirty.update(routers)
+            # only routers that received something since the last poll can have changed their table
+            converged = set()
+            converged_at = None
+            start = loop.time()
+            while loop.time() - start < timeout:
+                await asyncio.sleep(poll_interval)
+                dirty = network.take_dirty()
+                if reference is None:
+                    # whether a table delivers depends on the other tables too, check them all
+                    if dirty:
+                        converged = tables_delivering({router_id: vr.routing_table for router_id, vr in routers.items()})
+                else:
+                    for router_id in dirty:
+                        vr = routers[router_id]
+                        if table_converged(router_id, vr.routing_table, graph, reference):
+                            converged.add(router_id)
+                        else:
+                            converged.discard(router_id)
+                if len(converged) == len(routers):
+                    converged_at = loop.time() - start
+                    break
+                if network.quiescent():
+                    # nothing left to deliver, retransmit or repair, the tables won't change anymore
+                    break
+            results.append((label, converged_at))
+            if converged_at is None:
+                break
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return results, list(routers.values())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(simulate())
+    finally:
+        loop.close()
+
+
+# Number of routers whose routing table currently agrees with the reference, or delivers with areas
+def count_converged(routers, graph, reference):
+    if reference is None:
+        return len(tables_delivering({vr.router_id: dict(vr.routing_table) for vr in routers}))
+    return sum(1 for vr in routers if table_converged(vr.router_id, dict(vr.routing_table), graph, reference))
+
+
+def print_counter(name, values, out):
+    print("{}: total {}, mean {:.1f}, max {} per router".format(name, sum(values), sum(values) / len(values), max(values)), file=out)
+
+
+def report(topology, results, routers, per_router, phases, engine='ls', out=sys.stdout):
+    print("routers: {}, links: {}".format(len(topology.routers), len(topology.links)), file=out)
+    for (label, converged_at), (_, _, graph, reference) in zip(results, phases):
+        if converged_at is None:
+            print("{}: did not converge ({} of {} routing tables correct)".format(label, count_converged(routers, graph, reference), len(routers)), file=out)
+        else:
+            print("{}: time to converge: {:.3f} s".format(label, converged_at), file=out)
+    if engine == 'dv':
+        print_counter("vector messages sent", [vr.messages_sent for vr in routers], out)
+        print_counter("vector entries sent", [vr.entries_sent for vr in routers], out)
+        print_counter("bytes sent", [vr.bytes_sent for vr in routers], out)
+        vector_sizes = [vr.lsdb_size() for vr in routers]
+        print("vector entries held: mean {:.1f}, max {} per router".format(sum(vector_sizes) / len(routers), max(vector_sizes)), file=out)
+    else:
+        print_counter("LSAs sent", [vr.lsa_sent for vr in routers], out)
+        print_counter("LSA messages sent", [vr.messages_sent for vr in routers], out)
+        print("LSAs received: {}, dropped as already seen: {}, flooded on: {}".format(
+            sum(vr.lsa_received for vr in routers), sum(vr.lsa_dropped for vr in routers), sum(vr.lsa_forwarded for vr in routers)), file=out)
+        print_counter("SPF runs", [vr.spf_runs for vr in routers], out)
+        spf_times = [vr.spf_time for vr in routers]
+        print("SPF time: total {:.3f} s, max {:.3f} s per router".format(sum(spf_times), max(spf_times)), file=out)
+        print("retransmissions: {}, ack messages: {}".format(sum(vr.retransmissions for vr in routers), sum(vr.acks_sent for vr in routers)), file=out)
+        print_counter("bytes sent", [vr.bytes_sent for vr in routers], out)
+        lsdb_sizes = [vr.lsdb_size() for vr in routers]
+        print("LSDB entries: mean {:.1f}, max {} per router".format(sum(lsdb_sizes) / len(routers), max(lsdb_sizes)), file=out)
+
+    if per_router:
+        names = routers[0].COUNTERS
+        print("router,{},{}".format(','.join(names), 'vector_entries' if engine == 'dv' else 'lsdb_entries'), file=out)
+        for vr in sorted(routers, key=lambda vr: vr.router_id):
+            counters = vr.counters()
+            print("{},{},{}".format(vr.router_id, ','.join(str(round(counters[name], 6)) for name in names), vr.lsdb_size()), file=out)
+
+
+# Engines side by side: time to converge after every phase, routing messages (acks included) and bytes sent
+def report_comparison(runs, phases, out=sys.stdout):
+    labels = [label for label, _, _, _ in phases]
+    print("engine,{},messages,bytes".format(','.join(labels)), file=out)
+    for engine, (results, routers) in runs.items():
+        times = dict(results)
+        converged = ['{:.3f}'.format(times[label]) if times.get(label) is not None else '-' for label in labels]
+        messages = sum(vr.messages_sent + vr.acks_sent for vr in routers)
+        print("{},{},{},{}".format(engine, ','.join(converged), messages, sum(vr.bytes_sent for vr in routers)), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long the virtual routers take to converge on a topology")
+    parser.add_argument('topology_file')
+    parser.add_argument('--mode', choices=['threads', 'sim'], default='threads',
+                        help="threads: one socket per router through the NFE process; sim: every router on one asyncio loop over an in-memory NFE (default: threads)")
+    parser.add_argument('--port', type=int, help="NFE port (default: a free port)")
+    parser.add_argument('--latency', type=float, default=0.0, help="sim mode: one-way link latency in seconds (default: 0)")
+    parser.add_argument('--loss', type=float, default=0.0, help="probability of the NFE losing each relayed message (default: 0)")
+    parser.add_argument('--no-files', action='store_true', help="don't write topology and routing table files")
+    parser.add_argument('--single-lsa', action='store_true', help="routers send one LSA per message instead of packed LSAs")
+    parser.add_argument('--engine', choices=['ls', 'dv', 'both'], default='ls',
+                        help="routing engine: link state, distance vector, or both one after the other for a comparison (default: ls)")
+    parser.add_argument('--workdir', help="directory for the NFE log and router output files (default: a temporary directory)")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for convergence (default: 60)")
+    parser.add_argument('--poll-interval', type=float, default=0.01)
+    parser.add_argument('--per-router', action='store_true', help="print counters of every router")
+    parser.add_argument('--link-event', action='append', default=[], metavar='LINK:COST',
+                        help="after convergence, set a link's cost ('down', 'up' or a number) and measure reconvergence; repeatable")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    topology = load_topology(args.topology_file)
+    phases = build_phases(topology, [parse_link_event(event, topology) for event in args.link_event])
+    workdir = args.workdir or tempfile.mkdtemp(prefix='a3-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    # the in-memory NFE of sim mode prints what it relays like the NFE process, keep it out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    # the routers write their topology/routing table files into the current directory
+    os.chdir(workdir)
+
+    engines = ['ls', 'dv'] if args.engine == 'both' else [args.engine]
+    runs = {}
+    for engine in engines:
+        # every engine gets its own directory for its files, and its own NFE
+        engine_dir = os.path.join(workdir, engine) if len(engines) > 1 else workdir
+        os.makedirs(engine_dir, exist_ok=True)
+        os.chdir(engine_dir)
+        router_class, simulated_router_class = ENGINES[engine]
+        router_options = {'write_files': not args.no_files}
+        if engine == 'ls':
+            router_options['packed'] = not args.single_lsa
+        if args.mode == 'sim':
+            runs[engine] = run_simulation(topology, phases, args.timeout, args.poll_interval, args.latency, args.loss, router_options, simulated_router_class)
+        else:
+            port = free_port() if args.port is None or engine != engines[0] else args.port
+            nfe = start_nfe(os.path.join(cwd, args.topology_file), port, engine_dir, ['--loss', str(args.loss)])
+            try:
+                runs[engine] = run_threads(topology, port, phases, args.timeout, args.poll_interval, router_options, router_class, stop=engine != engines[-1])
+            finally:
+                nfe.kill()
+                nfe.wait()
+
+    for engine, (results, routers) in runs.items():
+        if len(runs) > 1:
+            print("{}:".format({'ls': "link state", 'dv': "distance vector"}[engine]), file=stdout)
+        report(topology, results, routers, args.per_router, phases, engine, stdout)
+    if len(runs) > 1:
+        report_comparison(runs, phases, stdout)
+    print("output files in {}".format(workdir), file=stdout)
+    stdout.flush()
+    # router threads are still blocked on their sockets, don't wait for them
+    converged = all(len(results) == len(phases) and results[-1][1] is not None for results, routers in runs.values())
+    os._exit(0 if converged else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""distancevector.py: A virtual router running distance-vector (Bellman-Ford) routing instead of link state."""
+
+import time
+import struct
+import logging
+from nfe import LINK_DOWN, LINK_COST, DATA, DISTANCE_VECTOR
+from virtualrouter import VirtualRouter
+
+# Distance vector message header: type, sender_id, sender_link_id, count; then destination_id, cost per entry
+VECTOR_HEADER = struct.Struct("!iiii")
+VECTOR_ENTRY = struct.Struct("!ii")
+
+
+class DistanceVectorRouter(VirtualRouter):  # same NFE, links and files, routes computed from the neighbours' vectors
+    COUNTERS = ('messages_sent', 'entries_sent', 'bytes_sent', 'entries_received', 'messages_dropped', 'data_forwarded', 'data_delivered', 'data_dropped')
+
+    VECTOR_MAX = 500  # entries per message, 16 + 500 * 8 bytes fit the 4096 byte receive buffer
+
+    def __init__(self, nfe_ip, nfe_port, vrid, infinity=1024, **kwargs):
+        super().__init__(nfe_ip, nfe_port, vrid, **kwargs)
+
+        # A cost this high means unreachable; counting to infinity stops there, so it has to exceed the longest path
+        self.infinity = infinity
+
+        # Latest vector of the router at the other end of every link that is up: link id -> {destination: cost}
+        self.vectors = {}
+
+        # Router at the other end of every link, learned from its vectors: link id -> router id
+        self.link_neighbours = {}
+
+        # When the last vector arrived over every link; a link silent for max_age seconds is treated as down
+        self.last_heard = {}
+
+        # Best routes: destination -> (cost, frozenset of links to the equal-cost next hops)
+        self.routes = {}
+
+        # Destinations that became unreachable, advertised at infinity until then: destination -> time
+        self.unreachable = {}
+
+        # Destinations whose advertised cost changed, sent in the next triggered update
+        self.triggered = set()
+
+        # Number of vector entries sent and received, for benchmarking; vector messages count in messages_sent
+        self.entries_sent = 0
+        self.entries_received = 0
+
+
+    # Serialize a distance vector message, entries are (destination id, cost)
+    def vector_serialize(self, sender_link_id, entries):
+        data = VECTOR_HEADER.pack(DISTANCE_VECTOR, self.router_id, sender_link_id, len(entries))
+        for entry in entries:
+            data += VECTOR_ENTRY.pack(*entry)
+        return data
+
+
+    # Parse a distance vector message, returns the sender id and the (destination id, cost) entries, None if it is cut short
+    def vector_parse(self, buffer):
+        message_type, sender_id, sender_link_id, count = VECTOR_HEADER.unpack_from(buffer)
+        if VECTOR_HEADER.size + VECTOR_ENTRY.size * count != len(buffer):
+            return None
+        return sender_id, list(VECTOR_ENTRY.iter_unpack(buffer[VECTOR_HEADER.size:]))
+
+
+    # Cost this router advertises to destination over a link: poison reverse, routes through the link are advertised at infinity
+    def advertised_cost(self, destination, link_id):
+        if destination == self.router_id:
+            return 0
+        route = self.routes.get(destination)
+        if route is None or link_id in route[1]:
+            return self.infinity
+        return route[0]
+
+
+    # Every destination this router advertises: itself, its routes, and the routes it lost recently
+    def vector_destinations(self):
+        return [self.router_id] + sorted(self.routes) + sorted(self.unreachable)
+
+
+    # Send the advertised costs of some destinations over one link, in as few messages as possible
+    def send_vector(self, link_id, destinations):
+        entries = [(destination, self.advertised_cost(destination, link_id)) for destination in destinations]
+        if self.trace_sent.isEnabledFor(logging.DEBUG):
+            self.trace_sent.debug('vector over link %d: %s', link_id, ' '.join('{}:{}'.format(*entry) for entry in entries))
+        for i in range(0, len(entries), self.VECTOR_MAX):
+            data = self.vector_serialize(link_id, entries[i:i + self.VECTOR_MAX])
+            self.send(data)
+            self.messages_sent += 1
+            self.bytes_sent += len(data)
+        self.entries_sent += len(entries)
+
+
+    # Triggered update: the destinations whose route changed go out on every link once the messages at hand are handled
+    def flush_send_queues(self):
+        if not self.triggered:
+            return
+        destinations, self.triggered = sorted(self.triggered), set()
+        for link_id in self.neighbors:
+            self.send_vector(link_id, destinations)
+
+
+    def has_pending(self):
+        return bool(self.triggered)
+
+
+    # Bellman-Ford for some destinations: the cheapest link cost plus advertised cost over all links, keeping every equal-cost link
+    def recompute(self, destinations):
+        changed = False
+        now = time.monotonic()
+        for destination in destinations:
+            if destination == self.router_id:
+                continue
+            best = None
+            links = []
+            for link_id, vector in self.vectors.items():
+                cost = vector.get(destination)
+                if cost is None:
+                    continue
+                total = self.link_costs[link_id] + cost
+                if total >= self.infinity:
+                    continue
+                if best is None or total < best:
+                    best, links = total, [link_id]
+                elif total == best:
+                    links.append(link_id)
+
+            route = None if best is None else (best, frozenset(links))
+            if route == self.routes.get(destination):
+                continue
+            changed = True
+            # even with the same cost, the links it is poisoned on changed
+            self.triggered.add(destination)
+            if route is None:
+                del self.routes[destination]
+                self.unreachable[destination] = now + self.max_age
+                self.remove_route(destination)
+                continue
+            self.routes[destination] = route
+            self.unreachable.pop(destination, None)
+            entry = (best, tuple(sorted(set(self.link_neighbours[link_id] for link_id in links))))
+            if self.routing_table.get(destination) != entry:
+                self.last_change = now
+                self.routing_table[destination] = entry
+                self.routingtable_file.update(destination, (entry[1], entry[0]))
+                self.trace_routes.info('route to %d: cost %d via %s', destination, entry[0], entry[1])
+        if changed:
+            self.compile_fib()
+
+
+    # The FIB holds the links of the routes directly, there is no graph to look them up in
+    def compile_fib(self):
+        fib = [None] * (max(self.routes, default=0) + 1)
+        for destination, (cost, links) in self.routes.items():
+            fib[destination] = tuple(sorted(links))
+        self.fib = fib
+
+
+    # The router at the other end of a link sent a vector; a new neighbour on a link replaces the old one's vector
+    def receive_vector(self, buffer):
+        link_id = struct.unpack("!i", buffer[8:12])[0]
+        if link_id not in self.neighbors:
+            # still in flight when the link went down
+            self.messages_dropped += 1
+            self.trace_dropped.debug('vector from link %d that is down', link_id)
+            return
+        parsed = self.vector_parse(buffer)
+        if parsed is None:
+            self.messages_dropped += 1
+            self.trace_dropped.debug('malformed vector from link %d', link_id)
+            return
+        sender_id, entries = parsed
+        self.entries_received += len(entries)
+        self.trace_received.debug('vector from router %d over link %d: %s', sender_id, link_id, entries)
+
+        self.last_heard[link_id] = time.monotonic()
+        changed = []
+        if self.link_neighbours.get(link_id) != sender_id:
+            changed.extend(self.forget_link(link_id))
+            self.link_neighbours[link_id] = sender_id
+            self.graph_add_link(self.router_id, sender_id, link_id, self.link_costs[link_id])
+        vector = self.vectors.setdefault(link_id, {})
+        for destination, cost in entries:
+            if cost >= self.infinity:
+                if vector.pop(destination, None) is not None:
+                    changed.append(destination)
+            elif vector.get(destination) != cost:
+                vector[destination] = cost
+                changed.append(destination)
+        if changed:
+            self.last_change = time.monotonic()
+            self.recompute(changed)
+
+
+    # Drop the vector and the topology entry of a link, returns the destinations it had routes to
+    def forget_link(self, link_id):
+        vector = self.vectors.pop(link_id, {})
+        self.last_heard.pop(link_id, None)
+        neighbour = self.link_neighbours.pop(link_id, None)
+        if neighbour is not None and self.graph.get(self.router_id, {}).get(neighbour, (None,))[0] == link_id:
+            self.graph_remove_link(self.router_id, neighbour)
+        return list(vector)
+
+
+    # The NFE reports that one of this router's links went down
+    def link_down(self, link_id):
+        if link_id not in self.neighbors:
+            return
+        self.trace_link.info('link %d down', link_id)
+        self.neighbors.discard(link_id)
+        self.last_change = time.monotonic()
+        self.recompute(self.forget_link(link_id))
+
+
+    # The NFE reports a new cost for one of this router's links, which may have been down until now
+    def link_cost_changed(self, link_id, link_cost):
+        was_up = link_id in self.neighbors
+        self.trace_link.info('link %d %s, cost %d', link_id, 'cost changed' if was_up else 'up', link_cost)
+        self.neighbors.add(link_id)
+        self.link_costs[link_id] = link_cost
+        self.last_change = time.monotonic()
+        neighbour = self.link_neighbours.get(link_id)
+        if neighbour is not None:
+            self.graph_add_link(self.router_id, neighbour, link_id, link_cost)
+        self.recompute(list(self.vectors.get(link_id, ())))
+        if not was_up:
+            # the router at the other end starts over, it needs the whole vector
+            self.last_heard[link_id] = time.monotonic()
+            self.send_vector(link_id, self.vector_destinations())
+
+
+    # Periodic update: the whole vector on every link. Links silent for max_age seconds are dropped,
+    # and routes lost more than max_age seconds ago are no longer advertised
+    def refresh(self):
+        now = time.monotonic()
+        silent = [link_id for link_id in self.neighbors if now - self.last_heard.setdefault(link_id, now) >= self.max_age]
+        for link_id in silent:
+            self.recompute(self.forget_link(link_id))
+        for destination in [destination for destination, until in self.unreachable.items() if until <= now]:
+            del self.unreachable[destination]
+        destinations = self.vector_destinations()
+        for link_id in self.neighbors:
+            self.send_vector(link_id, destinations)
+        self.schedule(self.refresh_interval, self.refresh)
+
+
+    # Number of vector entries held, the distance vector counterpart of the LSDB; safe to call from another thread
+    def lsdb_size(self):
+        return sum(len(vector) for vector in list(self.vectors.values()))
+
+
+    # Handle one message received from the NFE; LSAs of link state routers are not understood
+    def receive(self, buffer):
+        message_type = struct.unpack("!i", buffer[0:4])[0]
+        if message_type == DISTANCE_VECTOR:
+            self.receive_vector(buffer)
+        elif message_type == LINK_DOWN:
+            self.link_down(struct.unpack("!i", buffer[4:8])[0])
+        elif message_type == LINK_COST:
+            self.link_cost_changed(*struct.unpack("!ii", buffer[4:12]))
+        elif message_type == DATA:
+            self.forward_data(buffer)
+        else:
+            self.messages_dropped += 1
+            self.trace_dropped.debug('message of type %d, this router runs distance vector', message_type)
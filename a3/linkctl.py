@@ -0,0 +1,17 @@
+"""linkctl.py: Change the cost of a link in a running NFE, or take it down."""
+
+import sys
+import struct
+import socket
+from nfe import LINK_CONTROL
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        print("Usage: linkctl.py nfe_ip nfe_port link_id (down|COST)")
+        print("e.g. linkctl.py localhost 2000 7 down")
+        sys.exit(-1)
+    _, nfe_ip, nfe_port, link_id, cost = sys.argv
+    cost = -1 if cost == 'down' else int(cost)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(struct.pack("!iii", LINK_CONTROL, int(link_id), cost), (nfe_ip, int(nfe_port)))
@@ -11,4 +11,74 @@ def get_logger(name, level='INFO'):
     fh = logging.FileHandler('{}.out'.format(name), 'w', 'utf-8')
     fh.setFormatter(formatter)
     log.addHandler(fh)
-    return log
\ No newline at end of file
+    return log
+
+
+# Trace categories of the routers; the trace logger of a category and router is named trace.<category>.<router id>
+TRACE_CATEGORIES = ('received', 'sent', 'dropped', 'lsdb', 'spf', 'routes', 'link')
+
+
+# Trace logger of one category and router, silent unless enabled with enable_trace: records are
+# only formatted once enabled, so pass the values as arguments instead of formatting them first
+def get_tracer(category, router_id):
+    return logging.getLogger('trace.{}.{}'.format(category, router_id))
+
+
+# Write the trace of some categories, all of them if None, at level and above to stream, default stdout
+def enable_trace(categories=None, level='DEBUG', stream=None):
+    trace = logging.getLogger('trace')
+    if not trace.handlers:
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
+        trace.addHandler(handler)
+        trace.propagate = False
+    for name in (['trace'] if categories is None else ['trace.' + category for category in categories]):
+        logging.getLogger(name).setLevel(level)
+
+
+# Buffers changes to a keyed table and writes them to a logger in one block per flush
+#   diff mode:     only entries added (+), changed (~) or removed (-) since the last flush
+#   snapshot mode: the whole table, but only when something changed since the last flush
+class TableWriter:
+    def __init__(self, log, title, format_entry, snapshot=False):
+        self.log = log
+        self.title = title
+        self.format_entry = format_entry  # (key, value) -> line
+        self.snapshot = snapshot
+        self.written = {}  # table as of the last flush
+        self.pending = {}  # key -> new value, None when removed
+        self.blocks = 0
+
+    def update(self, key, value):
+        if self.log is not None:
+            self.pending[key] = value
+
+    def remove(self, key):
+        self.update(key, None)
+
+    def flush(self):
+        if not self.pending:
+            return
+        changes = []
+        for key, value in self.pending.items():
+            old = self.written.get(key)
+            if value == old:
+                continue
+            if value is None:
+                del self.written[key]
+                changes.append((key, '-', old))
+            else:
+                self.written[key] = value
+                changes.append((key, '+' if old is None else '~', value))
+        self.pending = {}
+        if not changes:
+            return
+
+        lines = ['\n' + self.title if self.blocks > 0 else self.title]
+        if self.snapshot:
+            lines.extend(self.format_entry(key, self.written[key]) for key in sorted(self.written))
+        else:
+            changes.sort(key=lambda change: change[0])
+            lines.extend(op + self.format_entry(key, value) for key, op, value in changes)
+        self.blocks += 1
+        self.log.info('\n'.join(lines))
@@ -1,7 +1,13 @@
+import argparse
+import asyncio
+import collections
+import gc
+import multiprocessing
 import socket
 import struct
 import sys
 import json
+import random
 
 """                                ___
                                ,-""   `.
@@ -27,19 +33,58 @@ import json
                     oh, hello there
 """
 
+# Message types, the first int32 of every UDP message
+INIT = 1          # router -> emulator: int32 router_id
+LSA = 3           # router -> emulator -> neighbour: int32 sender_id, sender_link_id, router_id, router_link_id, router_link_cost
+INIT_REPLY = 4    # emulator -> router: int32 nbr_links, then int32 link_id, link_cost per link
+LSA_SEQ = 5       # like LSA, followed by int32 sequence, age
+LINK_DOWN = 6     # emulator -> router: int32 link_id; the link stopped carrying traffic
+LINK_COST = 7     # emulator -> router: int32 link_id, link_cost; the link cost changed, or the link came back up
+LINK_CONTROL = 8  # anyone -> emulator: int32 link_id, link_cost; a negative cost takes the link down
+LSA_ACK = 9       # like LSA, int32 sender_id, sender_link_id, then int32 router_id, router_link_id, sequence per acknowledged LSA
+LSA_PACKED = 10   # like LSA, int32 sender_id, sender_link_id, version, count, then int32 router_id, router_link_id, router_link_cost, sequence, age per LSA
+DATA = 11         # like LSA, int32 sender_id, sender_link_id, source_id, destination_id, ttl, hops, packet_id, float64 sent_at, then the payload
+INIT_REPLY_AREAS = 12  # emulator -> router, instead of INIT_REPLY when the topology has areas: int32 nbr_links, then int32 link_id, link_cost, area per link
+DISTANCE_VECTOR = 13   # like LSA, int32 sender_id, sender_link_id, count, then int32 destination_id, cost per destination
+
+# Messages relayed between neighbours: type -> (fixed length, length of each repeated entry). All of them start
+# with int32 type, int32 sender_id, int32 sender_link_id, which is all the emulator needs to relay them
+RELAYED_MESSAGE_LENGTHS = {
+    LSA: (6 * 4, 0),
+    LSA_SEQ: (8 * 4, 0),
+    LSA_ACK: (3 * 4, 3 * 4),
+    LSA_PACKED: (5 * 4, 5 * 4),
+    DATA: (8 * 4 + 8, 1),
+    DISTANCE_VECTOR: (4 * 4, 2 * 4),
+}
+
+
+def valid_message_length(message_type, length):
+    fixed_length, entry_length = RELAYED_MESSAGE_LENGTHS[message_type]
+    if entry_length == 0:
+        return length == fixed_length
+    return length >= fixed_length and (length - fixed_length) % entry_length == 0
+
+
 class VirtualRouter: # holds data pertaining to UDP messages (and links (ip, port) of sender to a virtual router id)
+    __slots__ = ('address', 'router_id')
+
     def __init__(self, address, router_id):
         self.address = address
         self.router_id = router_id
 
 
 class Neighbour:  # router's neighbour
+    __slots__ = ('id', 'link')
+
     def __init__(self, router_id, link):
         self.id = router_id
         self.link = link
 
 
 class Router:
+    __slots__ = ('id', 'neighbours')
+
     def __init__(self, id):
         self.id = id
         self.neighbours = []
@@ -50,9 +95,12 @@ class Router:
 
 
 class Link:
-    def __init__(self, id, cost):
+    __slots__ = ('id', 'cost', 'area')
+
+    def __init__(self, id, cost, area=0):
         self.id = id
         self.cost = cost
+        self.area = area
     def __str__(self):
         return "<Link id={} cost={}>".format(self.id, self.cost)
     def __repr__(self):
@@ -62,14 +110,25 @@ class Link:
 class Topology:
     def __init__(self, topology_description):
         self.routers = []
+        self.routers_by_id = {}  # router id -> Router, so lookups don't scan self.routers
         self.links = []
         self.router_pairs = []
         self.original_topo_format = topology_description['links'] # needed for validation in other modules
 
-        self.parse_topology_description(topology_description)
+        # building tens of thousands of small objects keeps triggering the cyclic GC for nothing, none of them are garbage yet
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.parse_topology_description(topology_description)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
         self.validate_no_self_connection()
         self.validate_only_1_link()
         self.validate_connected()
+        self.validate_areas()
+        # routers are told the area of their links only when there is more than the backbone
+        self.has_areas = any(link.area != 0 for link in self.links)
 
     # why json.load() doesn't have a flag for this, I cannot fathom
     @staticmethod
@@ -92,6 +151,7 @@ class Topology:
         #     "3": [["1", "4"], "30"],
         #     "4": [["1", "3"], "55"]
         # }
+        # a link can have an area id after its cost, e.g. "3": [["1", "4"], "30", "1"]; links without one are in the backbone, area 0
 
         if(len(topology_description['links'])) == 0:
             raise Exception("The topology file seems to have no links; emulator needs at least one link between two routers")
@@ -100,9 +160,10 @@ class Topology:
             link_id = int(link_id_data)
             router_id1, router_id2 = int(link_data[0][0]), int(link_data[0][1])
             link_cost = int(link_data[1])
+            area = int(link_data[2]) if len(link_data) > 2 else 0
 
             # populate link info
-            link = Link(link_id, link_cost)
+            link = Link(link_id, link_cost, area)
             self.links.append(link)
 
             # populate router info
@@ -120,73 +181,98 @@ class Topology:
 
     def validate_only_1_link(self):
         # validate only 1 link between two routers
-        # sorting the pairs so that [2,1] becomes [1,2], such that comparison is simpler
-        # it's awkward but sort() is in-place
-        [pair.sort() for pair in self.router_pairs]
-
-        # it's n^2 but given the expected size, good enough
-        for index1, pair1 in enumerate(self.router_pairs):
-            for index2, pair2 in enumerate(self.router_pairs):
-                if index1 != index2 and pair1 == pair2:
-                    raise Exception("There is more than 1 link between router ids {}".format(pair1))
+        # pairs are normalised so that [2,1] and [1,2] are the same key
+        seen = set()
+        for router_id1, router_id2 in self.router_pairs:
+            pair = (router_id1, router_id2) if router_id1 <= router_id2 else (router_id2, router_id1)
+            if pair in seen:
+                raise Exception("There is more than 1 link between router ids {}".format(list(pair)))
+            seen.add(pair)
 
     def validate_connected(self):
         # validate they're all connected
-        visited = []
-        to_be_visited = [self.routers[0]]
-        while len(to_be_visited) > 0:
-            to_be_visited_temp = []
-            for router in to_be_visited:
-                visited.append(router) # we visited this router
-                for neighbour in router.neighbours:
-                    # don't wanna to visit in the future what we've already visited or already planning to visit
-                    neighbour_router_id = neighbour.id
-                    already_visited_ids = [visited_router.id for visited_router in visited]
-                    to_be_visited_ids = [visited_router.id for visited_router in (to_be_visited + to_be_visited_temp)]
-                    if (neighbour_router_id not in already_visited_ids) and (neighbour_router_id not in to_be_visited_ids):
-                        to_be_visited_temp.append(self.get_router_by_id(neighbour.id))
-            to_be_visited = to_be_visited_temp
-
-        if len(visited) != len(self.routers):
+        if len(self.reachable(self.routers[0])) != len(self.routers):
             raise Exception("The network seems to be partitioned i.e. there are 'islands' of inter-connected routers i.e. if we start at one router, we cannot visit every other router by hoping across links")
 
-    def get_router_by_id(self, id):
+    def validate_areas(self):
+        # with several areas, same rules as OSPF: every area is contiguous, there is a backbone (area 0),
+        # and a router with links in several areas (an area border router) has a link in the backbone
+        areas = collections.defaultdict(set)  # area -> routers with a link in it
+        for router in self.routers:
+            router_areas = set(neighbour.link.area for neighbour in router.neighbours)
+            if len(router_areas) > 1 and 0 not in router_areas:
+                raise Exception("Router {} connects areas {} but has no link in the backbone, area 0".format(router.id, sorted(router_areas)))
+            for area in router_areas:
+                areas[area].add(router.id)
+        if len(areas) < 2:
+            return
+        if 0 not in areas:
+            raise Exception("The topology has areas {} but no backbone, area 0".format(sorted(areas)))
+        # summary LSAs of area border routers take negative link ids, which encode ranges of router ids below 32768
         for router in self.routers:
-            if router.id == id:
-                return router
-        raise Exception("Emulator has messed something while validating if the topology is connected, I'm sorry. Try another topology")
+            if router.id >= 32768:
+                raise Exception("Router id {} is too large, with areas router ids have to be below 32768".format(router.id))
+            for neighbour in router.neighbours:
+                if neighbour.link.id < 0:
+                    raise Exception("Link id {} is negative, with areas link ids can't be negative".format(neighbour.link.id))
+        for area, router_ids in areas.items():
+            start = self.get_router_by_id(min(router_ids))
+            if len(self.reachable(start, area)) != len(router_ids):
+                raise Exception("Area {} is partitioned, the routers of an area have to be connected by links of that area".format(area))
+
+    def reachable(self, start, area=None):
+        # BFS from start over the links of one area, or all links; each router is queued at most once
+        visited = {start.id}
+        to_be_visited = collections.deque([start])
+        while to_be_visited:
+            router = to_be_visited.popleft()
+            for neighbour in router.neighbours:
+                if neighbour.id not in visited and (area is None or neighbour.link.area == area):
+                    visited.add(neighbour.id)
+                    to_be_visited.append(self.get_router_by_id(neighbour.id))
+        return visited
+
+    def get_router_by_id(self, id):
+        router = self.routers_by_id.get(id)
+        if router is None:
+            raise Exception("Emulator has messed something while validating if the topology is connected, I'm sorry. Try another topology")
+        return router
 
     def add_router_connection(self, router_id, link, other_router_id):
-        router = None
         # does this router already exist?
-        for r in self.routers:
-            if r.id == router_id:
-                router = r
-                break
-        else:
+        router = self.routers_by_id.get(router_id)
+        if router is None:
             # no? let's create it and add it to our collection
             router = Router(router_id)
             self.routers.append(router)
+            self.routers_by_id[router_id] = router
         router.add_neighbour(other_router_id, link)
 
 
 def main():
-    ip, port, topology = parse_args()
-    listen_loop(ip, port, topology)
+    ip, port, topology, workers, stats_interval, loss = parse_args()
+    listen_loop(ip, port, topology, workers, stats_interval, loss)
 
 
 
 def parse_args():
-    if len(sys.argv) != 4:
-        print("Emulator needs to bind a port on localhost and read in a topology file")
-        print("Usage: emulator ip port topology-file")
-        print("e.g. emulator 127.0.0.1 8080 ./topology.json")
-        sys.exit(-1)
+    parser = argparse.ArgumentParser(prog="emulator", description="Emulator needs to bind a port on localhost and read in a topology file",
+                                     epilog="e.g. emulator 127.0.0.1 8080 ./topology.json")
+    parser.add_argument("ip")
+    parser.add_argument("port")
+    parser.add_argument("topology_file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of forwarding processes sharing the port through SO_REUSEPORT (default: 1)")
+    parser.add_argument("--stats-interval", type=float, default=1.0,
+                        help="seconds between forwarding counter reports (default: 1.0)")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="probability of dropping each relayed message, to test the routers against a lossy network (default: 0)")
+    args = parser.parse_args()
 
     topology = None
-    filepath = sys.argv[3]
-    port = sys.argv[2]
-    ip = sys.argv[1]
+    filepath = args.topology_file
+    port = args.port
+    ip = args.ip
     try:
         port = int(port)
         if port > 65535 or port < 1:
@@ -196,6 +282,17 @@ def parse_args():
         print("Argument error: first argument `port` needs to be a port number between 1 and 65535")
         sys.exit(-1)
 
+    if args.workers < 1:
+        print("Argument error: `--workers` needs to be at least 1")
+        sys.exit(-1)
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("Argument error: `--workers` greater than 1 needs SO_REUSEPORT, which this platform doesn't support")
+        sys.exit(-1)
+
+    if not 0 <= args.loss < 1:
+        print("Argument error: `--loss` needs to be a probability between 0 and 1")
+        sys.exit(-1)
+
     try:
         with open(filepath) as fd:
             topology = Topology(json.load(fd, object_pairs_hook=Topology.dup_key_verify))
@@ -203,14 +300,22 @@ def parse_args():
         print("Either couldn't open {} or couldn't parse JSON to construct desired topology: {}".format(filepath, str(e)))
         sys.exit(-1)
 
-    return ip, port, topology
+    return ip, port, topology, args.workers, args.stats_interval, args.loss
 
 
-def listen_loop(ip, port, topology):
+def bind_socket(ip, port, reuse_port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        # every worker binds the same (ip, port); the kernel spreads datagrams across them by source address hash
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((ip, port))
+    return sock
+
 
+def init_phase(sock, topology):
     clients = []
+    client_ids = set()
+    router_ids = set(r.id for r in topology.routers)
     expected_clients = len(topology.routers)
 
     # Waiting for init messages; noting down which router id goes with which udp client
@@ -224,7 +329,7 @@ def listen_loop(ip, port, topology):
 
         message_type_buffer = buffer[:4]
         message_type = struct.unpack("!i", message_type_buffer)[0]
-        if message_type not in [1,2,3]:
+        if message_type not in [1,2,3,LSA_SEQ,LINK_CONTROL]:
             print("UDP message has an unknown message_type (the first four bytes). Message type received: {} ({})".format(message_type, ' '.join('0x{:02x}'.format(byte) for byte in message_type_buffer)))
             continue
 
@@ -239,86 +344,226 @@ def listen_loop(ip, port, topology):
         router_id_buffer = buffer[4:8]
         router_id = struct.unpack("!i", router_id_buffer)[0]
 
-        if router_id not in [r.id for r in topology.routers]:
+        if router_id not in router_ids:
             print("Received Init from router id {} but that router id is not in the topology, ignoring".format(router_id))
             continue
 
-        if router_id in [c.router_id for c in clients]:
+        if router_id in client_ids:
             print("Received Init from router id {} but that router id has already been received, ignoring".format(router_id))
             continue
         print("Received Init from virtual router id {} correctly, from udp (ip, port) {})".format(router_id, address))
         clients.append(VirtualRouter(address, router_id))
+        client_ids.add(router_id)
 
     # Sending the clients their info
     print("Emulator sending link info to virtual routers")
     for client in clients:
-        router = topology.get_router_by_id(client.router_id)
-        # int32 type (0x4)
-        # int32 nbrLinks
-        # int32 link_id
-        # int32 link_cost
-        router_links = [n.link for n in router.neighbours]
-
-        data = struct.pack("!i", 4) # message type, 0x4
-        data += struct.pack("!i", len(router_links))  # nbr links
-
-        for link in router_links:
-            data += struct.pack("!i", link.id) # link_id
-            data += struct.pack("!i", link.cost)  # link_cost
+        data = init_reply(topology.get_router_by_id(client.router_id), topology.has_areas)
         print("Sending data to virtual router {}".format(client.router_id))
         sock.sendto(data, client.address)
 
-    # Forwarding
-    print("Emulator forwarding traffic between virtual routers")
-
-    while True:
-        buffer, address = sock.recvfrom(4096)
+    return clients
+
+
+def init_reply(router, with_areas=False):
+    # int32 type (0x4, or 0xc with areas)
+    # int32 nbrLinks
+    # int32 link_id
+    # int32 link_cost
+    # int32 area, with areas only
+    router_links = [n.link for n in router.neighbours]
+
+    data = struct.pack("!i", INIT_REPLY_AREAS if with_areas else INIT_REPLY) # message type
+    data += struct.pack("!i", len(router_links))  # nbr links
+
+    for link in router_links:
+        data += struct.pack("!i", link.id) # link_id
+        data += struct.pack("!i", link.cost)  # link_cost
+        if with_areas:
+            data += struct.pack("!i", link.area)  # area
+    return data
+
+
+class ForwardingTables:  # lookup tables for the forwarding phase, so each datagram costs O(1) instead of scanning clients and routers
+    def __init__(self, topology, clients):
+        # address -> topology router of the virtual router bound to that address
+        self.router_by_address = {}
+        # (router_id, sender_link_id) -> (address of the virtual router at the other end of that link, link index)
+        self.neighbour_address = {}
+        # link id -> index into link_costs
+        self.link_index = {link.id: index for index, link in enumerate(topology.links)}
+        # link id -> addresses of the two virtual routers it connects
+        self.link_endpoints = collections.defaultdict(list)
+        # current cost of every link, negative when the link is down; shared memory, so every forked worker sees changes
+        self.link_costs = multiprocessing.RawArray('i', [link.cost for link in topology.links])
+
+        client_address_by_id = {client.router_id: client.address for client in clients}
         for client in clients:
-            if client.address == address:
-                router = topology.get_router_by_id(client.router_id)
-                break
-        else:
+            router = topology.get_router_by_id(client.router_id)
+            self.router_by_address[client.address] = router
+            for neighbour in router.neighbours:
+                if neighbour.id not in client_address_by_id:
+                    raise Exception("The emulator couldn't find an address it should have been able to find, sorry. This is a bug. Try another topology")
+                self.neighbour_address[(router.id, neighbour.link.id)] = (client_address_by_id[neighbour.id], self.link_index[neighbour.link.id])
+                self.link_endpoints[neighbour.link.id].append(client.address)
+
+
+class Forwarder:  # forwarding phase of one worker: drains its socket in batches and relays to neighbours
+    BATCH_SIZE = 256  # max datagrams read per readiness event, so one busy socket can't starve the stats timer
+
+    def __init__(self, sock, tables, name, loss=0.0):
+        self.sock = sock
+        self.tables = tables
+        self.router_by_address = tables.router_by_address
+        self.neighbour_address = tables.neighbour_address
+        self.link_costs = tables.link_costs
+        self.name = name
+        # probability of losing a relayed message on purpose; each worker seeds its own generator
+        self.loss = loss
+        self.random = random.Random()
+        self.received = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.lost = 0
+
+    def drain(self):
+        recvfrom = self.sock.recvfrom
+        for _ in range(self.BATCH_SIZE):
+            try:
+                buffer, address = recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.received += 1
+            self.forward(buffer, address)
+
+    def forward(self, buffer, address):
+        if len(buffer) < 12:
+            print("UDP message from (ip, port) {} is only {} byte(s) long, expected at least 12 bytes, ignoring".format(address, len(buffer)))
+            self.dropped += 1
+            return
+
+        # int32 type
+        # int32 sender_id (link_id for LINK_CONTROL)
+        # int32 sender_link_id (link_cost for LINK_CONTROL)
+        message_type, _, sender_link_id = struct.unpack_from("!iii", buffer)
+        if message_type == LINK_CONTROL:
+            self.control(buffer)
+            return
+
+        router = self.router_by_address.get(address)
+        if router is None:
             print("Received data from virtual router (ip, port) {} but that virtual router did not send an init message during the init phase, ignoring".format(address))
-            continue
-
-        # int32 type (0x3)
-        # int32 sender_id
-        # int32 sender_link_id
-        # int32 router_id
-        # int32 router_link_id
-        # int32 router_link_cost
-        if len(buffer) != (6 * 4): # 7 fields, 32-bit (4 bytes) each
-            print("Virtual Router {} - message length is {} but that doesn't match expected size, ignoring".format(router.id, len(buffer)))
-            continue
+            self.dropped += 1
+            return
 
-        data = struct.unpack("!iiiiii", buffer)
-        message_type = data[0]
-        if message_type != 3:
+        if message_type not in RELAYED_MESSAGE_LENGTHS:
             print("Virtual Router {} - message type is {} but that that's not the expected message type, ignoring".format(router.id, message_type))
-            continue
+            self.dropped += 1
+            return
 
-        sender_link_id = data[2]
+        if not valid_message_length(message_type, len(buffer)):
+            print("Virtual Router {} - message length is {} but that doesn't match expected size, ignoring".format(router.id, len(buffer)))
+            self.dropped += 1
+            return
 
         # the virtual router whose LSA message we just received wants that LSA forwarded to some neighbouring router
-        # virtual router  a link id gives
         # i.e. which neighbouring router is this going to, based on the link id of the sending router?
-        for neighbour in router.neighbours:
-            if sender_link_id == neighbour.link.id:
-                # found the neighbour its destined for, let's find that neighbour's address in clients
-                for client in clients:
-                    if client.router_id == neighbour.id:
-                        neighbour_address = client.address
-                        break
-                else:
-                    raise Exception("The emulator couldn't find an address it should have been able to find, sorry. This is a bug. Try another topology")
-                sock.sendto(buffer, neighbour_address)
-                print(".", end='', flush=True)
-                break
-        else:
+        neighbour = self.neighbour_address.get((router.id, sender_link_id))
+        if neighbour is None:
             print("Virtual Router {} - message cannot be forwarded, the sender_link_id is invalid, ignoring (emulator doesn't know through which of its link "
                   "the virtual router would like to send the message)".format(router.id))
             print(sender_link_id, router.id, [n.link.id for n in router.neighbours])
-            continue
+            self.dropped += 1
+            return
+        destination, link_index = neighbour
+        if self.link_costs[link_index] < 0:
+            # the link is down, it carries nothing
+            self.dropped += 1
+            return
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return
+        try:
+            self.sock.sendto(buffer, destination)
+        except (BlockingIOError, InterruptedError):
+            # the send buffer is full; UDP is allowed to lose it, the same way the kernel would
+            self.dropped += 1
+            return
+        self.forwarded += 1
+
+    def control(self, buffer):
+        # int32 type (0x8)
+        # int32 link_id
+        # int32 link_cost, negative to take the link down
+        if len(buffer) != 3 * 4:
+            print("Link control message is {} bytes long, expected to be 12 bytes, ignoring".format(len(buffer)))
+            return
+        _, link_id, link_cost = struct.unpack("!iii", buffer)
+        link_index = self.tables.link_index.get(link_id)
+        if link_index is None:
+            print("Link control message for link id {} but that link is not in the topology, ignoring".format(link_id))
+            return
+        self.link_costs[link_index] = link_cost
+
+        # tell both ends, they advertise the change to everyone else
+        if link_cost < 0:
+            print("{}Link {} is down".format(self.name, link_id), flush=True)
+            data = struct.pack("!ii", LINK_DOWN, link_id)
+        else:
+            print("{}Link {} is up with cost {}".format(self.name, link_id, link_cost), flush=True)
+            data = struct.pack("!iii", LINK_COST, link_id, link_cost)
+        for address in self.tables.link_endpoints[link_id]:
+            self.sock.sendto(data, address)
+
+    async def report(self, interval):
+        # counters instead of a terminal write per datagram
+        last_forwarded = 0
+        while True:
+            await asyncio.sleep(interval)
+            if self.forwarded != last_forwarded:
+                print("{}forwarded {} ({:.0f}/s), received {}, dropped {}, lost {}".format(
+                    self.name, self.forwarded, (self.forwarded - last_forwarded) / interval, self.received, self.dropped, self.lost), flush=True)
+                last_forwarded = self.forwarded
+
+
+def serve(sock, tables, stats_interval, name='', loss=0.0):
+    sock.setblocking(False)
+    forwarder = Forwarder(sock, tables, name, loss)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_reader(sock.fileno(), forwarder.drain)
+    try:
+        loop.run_until_complete(forwarder.report(stats_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.remove_reader(sock.fileno())
+        loop.close()
+
+
+def serve_worker(ip, port, tables, stats_interval, loss, worker_id):
+    sock = bind_socket(ip, port, reuse_port=True)
+    serve(sock, tables, stats_interval, "[worker {}] ".format(worker_id), loss)
+
+
+def listen_loop(ip, port, topology, workers=1, stats_interval=1.0, loss=0.0):
+    sock = bind_socket(ip, port, reuse_port=workers > 1)
+
+    clients = init_phase(sock, topology)
+    tables = ForwardingTables(topology, clients)
+
+    # Forwarding
+    print("Emulator forwarding traffic between virtual routers")
+
+    # extra workers join the SO_REUSEPORT group only now, the init phase has to be seen by a single socket
+    processes = []
+    context = multiprocessing.get_context("fork")
+    for worker_id in range(1, workers):
+        process = context.Process(target=serve_worker, args=(ip, port, tables, stats_interval, loss, worker_id), daemon=True)
+        process.start()
+        processes.append(process)
+
+    serve(sock, tables, stats_interval, "[worker 0] " if workers > 1 else '', loss)
 
 if __name__ == '__main__':
     main()
@@ -1,14 +1,18 @@
 #!/bin/bash
 
-./virtualrouter.sh localhost 2000 1 &
-./virtualrouter.sh localhost 2000 2 &
-./virtualrouter.sh localhost 2000 3 &
-./virtualrouter.sh localhost 2000 4 &
-./virtualrouter.sh localhost 2000 5 &
-./virtualrouter.sh localhost 2000 6 &
-./virtualrouter.sh localhost 2000 7 &
+# Every router exits by itself once its routing table has been stable for 2 seconds (status 0),
+# or after 60 seconds if it never gets there (status 1)
+pids=()
+for vrid in 1 2 3 4 5 6 7; do
+    ./virtualrouter.sh localhost 2000 $vrid --idle-exit 2000 --timeout 60 &
+    pids+=($!)
+done
 
-sleep 10
-
-pkill virtualrouter.sh
-pkill python3
\ No newline at end of file
+status=0
+for i in "${!pids[@]}"; do
+    if ! wait ${pids[$i]}; then
+        echo "virtual router $((i + 1)) did not converge"
+        status=1
+    fi
+done
+exit $status
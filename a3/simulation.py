@@ -0,0 +1,176 @@
+"""simulation.py: Run many virtual routers on one asyncio loop over an in-memory NFE."""
+
+import time
+import asyncio
+import struct
+import nfe
+from virtualrouter import VirtualRouter
+from distancevector import DistanceVectorRouter
+
+
+class SimulatedNetwork:  # stands in for the NFE process and its UDP socket
+
+    def __init__(self, topology, latency=0.0, loss=0.0):
+        self.topology = topology
+
+        # One-way delay of every relayed datagram, in seconds
+        self.latency = latency
+
+        # Probability of losing a relayed datagram
+        self.loss = loss
+
+        # Router id -> inbox of datagrams waiting to be received
+        self.inboxes = {}
+
+        # Router id -> router
+        self.routers = {}
+
+        # Routers that sent their init message so far
+        self.clients = []
+
+        # Datagrams sent but not yet handled by the receiving router
+        self.in_flight = 0
+
+        # Routers that received something since the last call to take_dirty()
+        self.dirty = set()
+
+        # Relays datagrams with the exact NFE forwarding logic; router ids play the role of UDP addresses
+        self.forwarder = None
+
+    # A router joins the network, must be called from within the running loop
+    def attach(self, router):
+        self.routers[router.router_id] = router
+        self.inboxes[router.router_id] = asyncio.Queue()
+        return self.inboxes[router.router_id]
+
+    # Datagram from a router to the NFE
+    def receive(self, router_id, data):
+        if self.forwarder is None:
+            self.receive_init(router_id, data)
+            return
+        lost = self.forwarder.lost
+        self.forwarder.forward(data, router_id)
+        if self.forwarder.lost > lost:
+            self.routers[router_id].message_lost()
+
+    # Init phase, same rules as nfe.init_phase: replies go out once every router has sent its init
+    def receive_init(self, router_id, data):
+        message_type, init_router_id = struct.unpack("!ii", data)
+        if message_type != 1 or init_router_id != router_id:
+            raise Exception("Virtual Router {} - expected an init message during the init phase".format(router_id))
+        self.clients.append(nfe.VirtualRouter(router_id, router_id))
+        if len(self.clients) < len(self.topology.routers):
+            return
+
+        self.forwarder = nfe.Forwarder(self, nfe.ForwardingTables(self.topology, self.clients), '', self.loss)
+        for client in self.clients:
+            self.sendto(nfe.init_reply(self.topology.get_router_by_id(client.router_id), self.topology.has_areas), client.address)
+
+    # Socket interface used by nfe.Forwarder
+    def sendto(self, data, router_id):
+        self.in_flight += 1
+        if self.latency > 0:
+            asyncio.get_event_loop().call_later(self.latency, self.inboxes[router_id].put_nowait, data)
+        else:
+            self.inboxes[router_id].put_nowait(data)
+
+    # A router finished handling one datagram
+    def delivered(self, router_id):
+        self.in_flight -= 1
+        self.dirty.add(router_id)
+
+    # Change the cost of a link, a negative cost takes it down; same as a LINK_CONTROL datagram to the NFE
+    def control(self, link_id, link_cost):
+        self.forwarder.forward(struct.pack("!iii", nfe.LINK_CONTROL, link_id, link_cost), None)
+
+    # Nothing in flight, and no router waits for an ack, is about to send something or to summarize its areas,
+    # or has yet to repair a lost message
+    def quiescent(self):
+        if self.forwarder is None or self.in_flight > 0:
+            return False
+        return not any(router.has_pending() for router in self.routers.values())
+
+    def take_dirty(self):
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+
+class SimulatedRouter(VirtualRouter):  # the unmodified protocol, talking to a SimulatedNetwork instead of a socket
+
+    def __init__(self, network, vrid, **kwargs):
+        self.network = network
+        self.inbox = None
+        # the loop callback running this router's timers, and when it is due
+        self.timer_handle = None
+        self.timer_deadline = None
+        super().__init__(None, None, vrid, **kwargs)
+
+    def open_socket(self):
+        return None
+
+    def send(self, data):
+        self.network.receive(self.router_id, data)
+
+    async def run(self):
+        self.inbox = self.network.attach(self)
+        self.init()
+        self.init_reply_parse(await self.recv())
+        self.network.delivered(self.router_id)
+        self.broadcast()
+        batch = 0
+        while True:
+            if self.inbox.empty() or batch >= self.RECEIVE_BATCH:
+                # same as the socket loop: what the last messages triggered goes out together
+                self.flush_send_queues()
+                batch = 0
+            if self.inbox.empty():
+                self.flush_files()
+            self.receive(await self.recv())
+            self.network.delivered(self.router_id)
+            self.flush_files_if_due()
+            batch += 1
+
+    def init(self):
+        self.send(self.init_serialize())
+
+    # The NFE lost a message this router sent; link state routers retransmit it until it's acknowledged
+    def message_lost(self):
+        pass
+
+    # No socket timeout to wake this router up, ask the loop to call back at the earliest deadline
+    def timer_armed(self, deadline):
+        if self.timer_handle is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer_handle.cancel()
+        self.timer_deadline = deadline
+        self.timer_handle = asyncio.get_event_loop().call_later(max(0.0, deadline - time.monotonic()), self.timer_fired)
+
+    def timer_fired(self):
+        self.timer_handle = None
+        self.run_timers()
+        self.flush_send_queues()
+        if self.timers:
+            self.timer_armed(self.timers[0][0])
+
+    async def recv(self, size=4096):
+        return await self.inbox.get()
+
+
+class SimulatedDistanceVectorRouter(SimulatedRouter, DistanceVectorRouter):  # the distance vector engine on the same in-memory NFE
+
+    def __init__(self, network, vrid, **kwargs):
+        super().__init__(network, vrid, **kwargs)
+        # a vector was lost since the last periodic update, which is the only thing that repairs it
+        self.lost_since_refresh = False
+
+    def message_lost(self):
+        self.lost_since_refresh = True
+
+    def refresh(self):
+        self.lost_since_refresh = False
+        super().refresh()
+
+    # Vectors aren't acknowledged, a lost one keeps the network busy until the next periodic update
+    def has_pending(self):
+        return super().has_pending() or self.lost_since_refresh
@@ -0,0 +1,305 @@
+"""topogen.py: Synthetic topology generator producing NFE topology JSON."""
+
+import sys
+import json
+import random
+import argparse
+import collections
+
+
+# Random connected graph: a random spanning tree, then extra random links until the average degree is reached
+def random_topology(n, degree, rng):
+    edges = set()
+    nodes = list(range(1, n + 1))
+    rng.shuffle(nodes)
+    for i in range(1, n):
+        u, v = nodes[i], nodes[rng.randrange(i)]
+        edges.add((min(u, v), max(u, v)))
+
+    target = min(int(n * degree / 2), n * (n - 1) // 2)
+    while len(edges) < target:
+        u, v = rng.randint(1, n), rng.randint(1, n)
+        if u != v:
+            edges.add((min(u, v), max(u, v)))
+    return edges
+
+
+# rows x cols grid, routers numbered row by row
+def grid_topology(rows, cols):
+    edges = set()
+    for r in range(rows):
+        for c in range(cols):
+            u = r * cols + c + 1
+            if c + 1 < cols:
+                edges.add((u, u + 1))
+            if r + 1 < rows:
+                edges.add((u, u + cols))
+    return edges
+
+
+# k-ary fat tree switches only: (k/2)^2 core, k pods of k/2 aggregation and k/2 edge switches
+def fat_tree_topology(k):
+    if k < 2 or k % 2 != 0:
+        raise ValueError("fat-tree arity k must be an even number >= 2")
+    half = k // 2
+    core = [i + 1 for i in range(half * half)]
+    next_id = len(core) + 1
+    edges = set()
+    for _ in range(k):
+        aggregation = list(range(next_id, next_id + half))
+        edge = list(range(next_id + half, next_id + k))
+        next_id += k
+        for i, a in enumerate(aggregation):
+            # aggregation switch i of every pod connects to core group i
+            for c in core[i * half:(i + 1) * half]:
+                edges.add((c, a))
+            for e in edge:
+                edges.add((a, e))
+    return edges
+
+
+# Barabasi-Albert preferential attachment, every new router attaches to m existing ones
+def scale_free_topology(n, m, rng):
+    if m < 1 or n <= m:
+        raise ValueError("scale-free needs 1 <= m < n")
+    edges = set()
+    # start from a small clique so early routers have degree > 0
+    for u in range(1, m + 2):
+        for v in range(u + 1, m + 2):
+            edges.add((u, v))
+    # every endpoint occurrence is one ticket, so picking uniformly picks proportionally to degree
+    tickets = [u for edge in edges for u in edge]
+    for u in range(m + 2, n + 1):
+        targets = set()
+        while len(targets) < m:
+            targets.add(rng.choice(tickets))
+        for v in targets:
+            edges.add((v, u))
+            tickets.extend((u, v))
+    return edges
+
+
+# Routers reachable from start over the given links, and the links taken to each: router -> (previous router, link)
+def bfs_tree(adjacency, start, allowed=None):
+    tree = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        u = queue.popleft()
+        for v in adjacency[u]:
+            edge = (min(u, v), max(u, v))
+            if v not in tree and (allowed is None or edge in allowed):
+                tree[v] = (u, edge)
+                queue.append(v)
+    return tree
+
+
+# Hops from start to every router
+def hop_counts(adjacency, start):
+    hops = {start: 0}
+    queue = collections.deque([start])
+    while queue:
+        u = queue.popleft()
+        for v in adjacency[u]:
+            if v not in hops:
+                hops[v] = hops[u] + 1
+                queue.append(v)
+    return hops
+
+
+# Links between the given routers
+def links_between(edges, routers):
+    return {(u, v) for u, v in edges if u in routers and v in routers}
+
+
+# Split a topology into k areas around a backbone, area 0, with few area border routers: regions are grown from k seeds
+# spread out as far as possible from each other. Routers that link regions join the backbone, those with the most such links
+# first, until no link joins two regions. Routers on shortest paths between pieces of the backbone join it until it is connected,
+# then backbone routers whose other neighbours are all in one region move to it, as long as the backbone stays connected.
+# The routers of a detour around every backbone link the backbone can't do without join it, and so do routers whose
+# neighbours are all in the backbone.
+# Links between backbone routers are in area 0, any other link is in the area of its router that isn't in the backbone, and
+# an area that falls apart gets a new id for every piece. Routers are renumbered area by area, so area border routers summarize
+# an area in few ranges of ids. Returns the renumbered edges and (u, v) -> area
+def assign_areas(edges, k, rng):
+    adjacency = collections.defaultdict(list)
+    for u, v in sorted(edges):
+        adjacency[u].append(v)
+        adjacency[v].append(u)
+    if not 2 <= k <= len(adjacency):
+        raise ValueError("areas must be between 2 and the number of routers")
+
+    # every next seed is a random one of the routers farthest from the seeds so far
+    routers = sorted(adjacency)
+    seeds = [rng.choice(routers)]
+    nearest = hop_counts(adjacency, seeds[0])
+    while len(seeds) < k:
+        farthest = max(nearest.values())
+        seeds.append(rng.choice([u for u in routers if nearest[u] == farthest]))
+        for u, hops in hop_counts(adjacency, seeds[-1]).items():
+            nearest[u] = min(nearest[u], hops)
+
+    # grow the regions together, one router at a time from their seeds, so they are connected
+    region = {}
+    queue = collections.deque()
+    for area, seed in enumerate(seeds, 1):
+        region[seed] = area
+        queue.append(seed)
+    while queue:
+        u = queue.popleft()
+        for v in adjacency[u]:
+            if v not in region:
+                region[v] = region[u]
+                queue.append(v)
+
+    # the backbone covers every link between regions
+    crossing = collections.defaultdict(set)
+    for u, v in edges:
+        if region[u] != region[v]:
+            crossing[u].add(v)
+            crossing[v].add(u)
+    backbone = set()
+    while crossing:
+        u = max(sorted(crossing), key=lambda u: len(crossing[u]))
+        backbone.add(u)
+        for v in crossing.pop(u):
+            crossing[v].discard(u)
+            if not crossing[v]:
+                del crossing[v]
+
+    # connect the backbone: join the piece of its first router to the nearest other backbone router
+    while True:
+        piece = bfs_tree(adjacency, min(backbone), links_between(edges, backbone))
+        if len(piece) == len(backbone):
+            break
+        tree = {u: None for u in piece}
+        queue = collections.deque(sorted(piece))
+        while queue:
+            u = queue.popleft()
+            if u in backbone and u not in piece:
+                break
+            for v in adjacency[u]:
+                if v not in tree:
+                    tree[v] = u
+                    queue.append(v)
+        while u is not None:
+            backbone.add(u)
+            u = tree[u]
+
+    # shrink it again; a backbone of one router would have no link in area 0
+    changed = True
+    while changed:
+        changed = False
+        for u in sorted(backbone, reverse=True):
+            regions = {region[v] for v in adjacency[u] if v not in backbone}
+            if len(regions) != 1 or len(backbone) <= 2:
+                continue
+            rest = backbone - {u}
+            if len(bfs_tree(adjacency, min(rest), links_between(edges, rest))) == len(rest):
+                backbone = rest
+                region[u] = regions.pop()
+                changed = True
+    if len(backbone) == 1:
+        backbone.add(adjacency[min(backbone)][0])
+
+    # a backbone link whose failure would split the backbone, but not the topology, gets the routers of the shortest
+    # detour around it, so the backbone survives the failure of any one link
+    changed = True
+    while changed:
+        changed = False
+        backbone_edges = links_between(edges, backbone)
+        for u, v in sorted(backbone_edges):
+            if v in bfs_tree(adjacency, u, backbone_edges - {(u, v)}):
+                continue
+            tree = bfs_tree(adjacency, u, set(edges) - {(u, v)})
+            if v in tree:
+                while v is not None:
+                    backbone.add(v)
+                    v = tree[v] and tree[v][0]
+                changed = True
+                break
+    # a router left with only backbone neighbours joins them rather than be an area of its own
+    backbone.update(u for u in routers if all(v in backbone for v in adjacency[u]))
+    areas = {(u, v): 0 if u in backbone and v in backbone else region[v if u in backbone else u] for u, v in edges}
+
+    # renumber the pieces of areas that fell apart
+    next_area = k + 1
+    for area in range(1, k + 1):
+        area_edges = {edge for edge, edge_area in areas.items() if edge_area == area}
+        first = True
+        while area_edges:
+            piece = bfs_tree(adjacency, min(area_edges)[0], area_edges)
+            piece_edges = {edge for edge in area_edges if edge[0] in piece}
+            area_edges -= piece_edges
+            if not first:
+                for edge in piece_edges:
+                    areas[edge] = next_area
+                next_area += 1
+            first = False
+
+    # the area of a router outside the backbone is that of all its links
+    router_areas = {u: 0 for u in backbone}
+    for (u, v), area in areas.items():
+        for w in (u, v):
+            if w not in backbone:
+                router_areas[w] = area
+    new_ids = {u: i for i, u in enumerate(sorted(adjacency, key=lambda u: (router_areas[u], u)), 1)}
+    renumbered = {}
+    for (u, v), area in areas.items():
+        u, v = sorted((new_ids[u], new_ids[v]))
+        renumbered[(u, v)] = area
+    return set(renumbered), renumbered
+
+
+# Turn a set of (u, v) router pairs into the NFE topology description, with the area of every link if given
+def to_topology_description(edges, min_cost, max_cost, rng, areas=None):
+    links = {}
+    for link_id, (u, v) in enumerate(sorted(edges), 1):
+        links[str(link_id)] = [[str(u), str(v)], str(rng.randint(min_cost, max_cost))]
+        if areas is not None:
+            links[str(link_id)].append(str(areas[(u, v)]))
+    return {'links': links}
+
+
+def generate(kind, size, degree=4, m=2, min_cost=1, max_cost=10, seed=None, areas=0):
+    rng = random.Random(seed)
+    if kind == 'random':
+        edges = random_topology(size, degree, rng)
+    elif kind == 'grid':
+        # size is the side length, grids are square
+        edges = grid_topology(size, size)
+    elif kind == 'fat-tree':
+        # size is the arity k
+        edges = fat_tree_topology(size)
+    elif kind == 'scale-free':
+        edges = scale_free_topology(size, m, rng)
+    else:
+        raise ValueError("unknown topology kind {}".format(kind))
+    if not areas:
+        return to_topology_description(edges, min_cost, max_cost, rng)
+    edges, link_areas = assign_areas(edges, areas, rng)
+    return to_topology_description(edges, min_cost, max_cost, rng, link_areas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a topology file for the NFE")
+    parser.add_argument('kind', choices=['random', 'grid', 'fat-tree', 'scale-free'])
+    parser.add_argument('size', type=int, help="routers for random/scale-free, side length for grid, arity k for fat-tree")
+    parser.add_argument('-o', '--output', help="output file (default: stdout)")
+    parser.add_argument('--degree', type=float, default=4, help="average degree of random topologies (default: 4)")
+    parser.add_argument('-m', type=int, default=2, help="links per new router in scale-free topologies (default: 2)")
+    parser.add_argument('--min-cost', type=int, default=1)
+    parser.add_argument('--max-cost', type=int, default=10)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--areas', type=int, default=0, help="split the topology into this many areas around a backbone, area 0 (default: no areas)")
+    args = parser.parse_args()
+
+    description = generate(args.kind, args.size, args.degree, args.m, args.min_cost, args.max_cost, args.seed, args.areas)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(description, fd, indent=2)
+    else:
+        json.dump(description, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""traffic.py: Send data messages through a converged virtual network, measure latency and throughput."""
+
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import tempfile
+import contextlib
+from benchmark import load_topology, build_phases, free_port, start_nfe, run_threads
+
+
+class Receiver:  # data sink of every router, called from the router threads
+
+    def __init__(self):
+        # (hops, latency in seconds, received at) of every delivered message
+        self.deliveries = []
+
+    def record(self, router_id, source, packet_id, hops, sent_at):
+        now = time.monotonic()
+        self.deliveries.append((hops, now - sent_at, now))
+
+
+# Send count messages between random pairs of routers, rate messages per second (0: as fast as possible). Every message
+# goes to the socket of its source router, which sends it on from its own thread: a router's socket and counters are
+# only ever used by that thread
+def generate(routers, count, rate, size, ttl, rng):
+    payload = bytes(size)
+    addresses = {vr.router_id: ('127.0.0.1', vr.sock.getsockname()[1]) for vr in routers}
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+        start = time.monotonic()
+        for packet_id in range(count):
+            source, destination = rng.sample(routers, 2)
+            sock.sendto(source.data_message(destination.router_id, packet_id, payload, ttl), addresses[source.router_id])
+            if rate:
+                delay = start + (packet_id + 1) / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+    return start
+
+
+# Value below which fraction of the sorted values are
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(count, start, receiver, routers, out=sys.stdout):
+    deliveries = list(receiver.deliveries)
+    dropped = sum(vr.data_dropped for vr in routers)
+    print("routers: {}, data messages sent: {}".format(len(routers), count), file=out)
+    print("delivered {}, dropped by routers {}, lost {}".format(len(deliveries), dropped, count - len(deliveries) - dropped), file=out)
+    if not deliveries:
+        return
+
+    hops = [hop for hop, _, _ in deliveries]
+    latencies = sorted(latency for _, latency, _ in deliveries)
+    per_hop = sorted(latency / hop for hop, latency, _ in deliveries)
+    duration = max(received_at for _, _, received_at in deliveries) - start
+    print("hops: mean {:.2f}, max {}".format(sum(hops) / len(hops), max(hops)), file=out)
+    print("latency: mean {:.3f} ms, p50 {:.3f} ms, p99 {:.3f} ms".format(
+        1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99)), file=out)
+    print("per-hop latency: mean {:.3f} ms, p50 {:.3f} ms, p99 {:.3f} ms".format(
+        1000 * sum(per_hop) / len(per_hop), 1000 * percentile(per_hop, 0.5), 1000 * percentile(per_hop, 0.99)), file=out)
+    print("throughput: {:.0f} messages/s delivered, {:.0f} hops/s relayed by the NFE".format(len(deliveries) / duration, sum(hops) / duration), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send data messages between random routers once the routing tables converged")
+    parser.add_argument('topology_file')
+    parser.add_argument('--count', type=int, default=10000, help="data messages to send (default: 10000)")
+    parser.add_argument('--rate', type=float, default=0, help="messages per second, 0 for as fast as possible (default: 0)")
+    parser.add_argument('--size', type=int, default=64, help="payload bytes per message (default: 64)")
+    parser.add_argument('--ttl', type=int, default=64)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--port', type=int, help="NFE port (default: a free port)")
+    parser.add_argument('--loss', type=float, default=0.0, help="probability of the NFE losing each relayed message (default: 0)")
+    parser.add_argument('--workdir', help="directory for the NFE log (default: a temporary directory)")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for convergence, and for the last deliveries (default: 60)")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    topology = load_topology(args.topology_file)
+    if len(topology.routers) < 2:
+        parser.error("the topology needs at least two routers")
+    workdir = args.workdir or tempfile.mkdtemp(prefix='a3-traffic-')
+    os.makedirs(workdir, exist_ok=True)
+
+    os.chdir(workdir)
+
+    port = args.port or free_port()
+    nfe = start_nfe(os.path.join(cwd, args.topology_file), port, workdir, ['--loss', str(args.loss)])
+    try:
+        results, routers = run_threads(topology, port, build_phases(topology, []), args.timeout, 0.01, {'write_files': False})
+        if results[0][1] is None:
+            print("routing tables did not converge within {} seconds".format(args.timeout))
+            sys.stdout.flush()
+            os._exit(1)
+
+        receiver = Receiver()
+        for vr in routers:
+            vr.data_sink = receiver.record
+        start = generate(routers, args.count, args.rate, args.size, args.ttl, random.Random(args.seed))
+
+        # wait for the messages still on their way
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            if len(receiver.deliveries) + sum(vr.data_dropped for vr in routers) >= args.count:
+                break
+            time.sleep(0.05)
+            if receiver.deliveries and time.monotonic() - receiver.deliveries[-1][2] > 1.0:
+                break # nothing arrived for a second, the rest is lost
+    finally:
+        nfe.kill()
+        nfe.wait()
+
+    report(args.count, start, receiver, routers)
+    sys.stdout.flush()
+    # router threads are still blocked on their sockets, don't wait for them
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
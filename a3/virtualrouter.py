@@ -3,16 +3,61 @@
 __author__      = "Ze Ran Lu (zrlu@uwaterloo.ca)"
 
 import sys
+import time
+import signal
 import struct
 import socket
-from nfe import Link
+import logging
+import argparse
+import itertools
+from nfe import LSA, LSA_SEQ, LINK_DOWN, LINK_COST, LSA_ACK, LSA_PACKED, DATA, INIT_REPLY_AREAS, valid_message_length
 from collections import defaultdict
 import heapq
-from logger import get_logger
+import zlib
+from logger import get_logger, TableWriter, TRACE_CATEGORIES, get_tracer, enable_trace
 
-class VirtualRouter:
+# Packed LSA format understood by this router; a neighbour sending another version gets single LSAs
+PACKED_LSA_VERSION = 1
+
+# Fields of one LSA, in the order they are packed
+LSA_FIELDS = ('router_id', 'router_link_id', 'router_link_cost', 'sequence', 'age')
+
+# Trace format of a parsed LSA, formatted by the logging module from the LSA dict only when the trace is enabled
+LSA_TRACE_FORMAT = 'SID(%(sender_id)s),SLID(%(sender_link_id)s),RID(%(router_id)s),RLID(%(router_link_id)s),LC(%(router_link_cost)s),SEQ(%(sequence)s),AGE(%(age)s)'
+
+# Trace format of an LSA tuple sent over a link, preceded by the sender id and link id
+LSA_SENT_TRACE_FORMAT = 'SID(%s),SLID(%s),RID(%s),RLID(%s),LC(%s),SEQ(%s),AGE(%s)'
+
+# Data message header: type, sender_id, sender_link_id, source_id, destination_id, ttl, hops, packet_id, sent_at
+DATA_HEADER = struct.Struct("!iiiiiiiid")
 
-    def __init__(self, nfe_ip, nfe_port, vrid):
+# Hops a data message may take before it is dropped
+DATA_TTL = 64
+
+# Summary LSAs of area border routers cover a run of router ids first..last, their link id is
+# -(first * SUMMARY_SPAN + last - first); with areas, router ids have to be below 32768
+SUMMARY_SPAN = 1 << 16
+
+class VirtualRouter:
+    # Counters reported by counters(), and dumped on SIGUSR1
+    COUNTERS = ('lsa_sent', 'messages_sent', 'bytes_sent', 'lsa_received', 'lsa_dropped', 'lsa_forwarded', 'messages_dropped',
+                'spf_runs', 'spf_time', 'retransmissions', 'acks_sent', 'data_forwarded', 'data_delivered', 'data_dropped')
+
+    RETRANSMIT_INTERVAL = 2.0  # seconds until an LSA that wasn't acknowledged is sent again, until acks measured the round trip time
+    RETRANSMIT_MIN = 0.2       # bounds of the retransmission timeout of a link, which doubles with every round of retransmissions
+    RETRANSMIT_MAX = 4.0
+    RETRANSMIT_BATCH = 256     # LSAs sent again per link and round at most, the oldest first
+    ACK_DELAY = 0.02           # received LSAs are acknowledged together after this delay,
+    ACK_BATCH = 64             # or as soon as this many acks are waiting for the same link
+    PACKED_LSA_MAX = 128       # LSAs per packed message, 20 + 128 * 20 bytes fit the 4096 byte receive buffer
+    RECEIVE_BATCH = 32         # messages handled before the LSAs they triggered are sent
+    SUMMARY_DELAY = 0.2        # an area border router summarizes its routing table once it didn't change for this long,
+    SUMMARY_HOLD_MAX = 8.0     # or this long after the first change; while its summaries keep changing, it waits twice
+                               # as long after every origination, up to this
+    SUMMARY_WITHDRAW_HOLD = 5  # seconds a withdrawn summary is kept before it ages out, long enough to be flooded
+
+    def __init__(self, nfe_ip, nfe_port, vrid, write_files=True, snapshot=False, flush_interval=1.0, refresh_interval=30.0, max_age=90.0, packed=True,
+                 idle_timeout=None, timeout=None):
 
         # The IP address of the NFE
         self.nfe_ip = nfe_ip
@@ -24,37 +69,143 @@ class VirtualRouter:
         self.router_id = vrid
 
         # Socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock = self.open_socket()
 
-        # Connected links
+        # Connected links that are up
         self.neighbors = set()
 
-        # Routing table
+        # Routing table: destination -> (cost, sorted tuple of equal-cost next hops)
         self.routing_table = {}
 
+        # Forwarding table compiled from the routing table, indexed by destination id:
+        # links to the equal-cost next hops, None if the destination is unreachable
+        self.fib = []
+
+        # Called with (router id, source id, packet id, hops, sent at) for every data message delivered here
+        self.data_sink = None
+
         # A graph representing the topology database
         self.graph = defaultdict(dict)
 
-        # All links
-        self.links = defaultdict(set)
+        # All links: link id -> {router id: cost} of the routers currently advertising it
+        self.links = defaultdict(dict)
+
+        # The two routers of every link currently in the graph: link id -> (u, v)
+        self.link_edges = {}
 
-        # Link costs
+        # Costs of this router's own links
         self.link_costs = {}
 
-        # All received LSA
-        self.lsa_seen_before = set()
+        # Areas of the links this router knows of, all in the backbone (area 0) unless the NFE reports areas,
+        # and the areas this router has links up in
+        self.link_areas = {}
+        self.areas = set()
+        self.area_routing = False
+
+        # Link state database of every attached area: area -> {(router id, link id) -> [sequence, cost, expires at]};
+        # a negative cost withdraws the link. Summary LSAs of area border routers have a negative link id, see SUMMARY_SPAN
+        self.lsdbs = defaultdict(dict)
+
+        # Summaries this router originates as an area border router: (area, first router id, last router id) -> cost;
+        # summaries_due is set while their origination is scheduled, since summaries_due_since. Summaries that changed
+        # were last originated at summarized_at, and aren't again within summary_hold seconds of that
+        self.summaries = {}
+        self.summaries_due = False
+        self.summaries_due_since = None
+        self.summarized_at = None
+        self.summary_hold = self.SUMMARY_DELAY
+
+        # Result of the last SPF run of every attached area, area -> (costs, next hops), reused when only summaries changed
+        self.spf = {}
+
+        # Sequence number of the latest LSA this router originated
+        self.sequence = 0
+
+        # Set when the graph, or the summaries of other areas, changed and the routing table has to be recomputed
+        self.graph_changed = False
+        self.summaries_changed = False
+
+        # Own LSAs are re-originated every refresh_interval seconds, other routers' LSAs expire after max_age seconds
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
 
-        # Topology file
-        self.topology_file = get_logger('topology_{}'.format(self.router_id))
+        # All timers of this router in one heap: (deadline, tie breaker, callback, args)
+        self.timers = []
+        self.timer_order = itertools.count()
 
-        # Used to avoid duplicate topology when writing
-        self.topology_update_buffer = ''
+        # LSAs sent and not acknowledged yet: link id -> {(router id, router link id): (sequence, sent at, sent again)}
+        self.retransmit = defaultdict(dict)
 
-        # Routingtable file
-        self.routingtable_file = get_logger('routingtable_{}'.format(self.router_id))
+        # Round trip time of every link measured from its acks, link id -> [smoothed, variation],
+        # and the retransmission timeout of the links that have one other than RETRANSMIT_INTERVAL
+        self.round_trips = {}
+        self.retransmit_timeouts = {}
 
-        # Used to avoid duplicate routing table when writing
-        self.routingtable_update_buffer = ''
+        # Links whose retransmission timer is running
+        self.retransmit_timers = set()
+
+        # Received LSAs to acknowledge: link id -> [(router id, router link id, sequence)]
+        self.pending_acks = defaultdict(list)
+
+        # LSAs waiting to be sent: link id -> {(router id, router link id): lsa}; a newer instance replaces a queued older one
+        self.send_queues = defaultdict(dict)
+
+        # Send several LSAs per message; links whose neighbour sent single LSAs fall back to single LSAs
+        self.packed = packed
+        self.single_lsa_links = set()
+
+        # Topology file, buffered; only changed entries are written unless in snapshot mode
+        self.topology_file = TableWriter(get_logger('topology_{}'.format(self.router_id)) if write_files else None,
+                                         'TOPOLOGY', lambda key, value: 'router:{},router:{},linkid:{},cost:{}'.format(*(key + value)), snapshot)
+
+        # Routingtable file, buffered the same way
+        self.routingtable_file = TableWriter(get_logger('routingtable_{}'.format(self.router_id)) if write_files else None,
+                                             'ROUTING', lambda key, value: '{}:{},{}'.format(key, '|'.join(str(hop) for hop in value[0]), value[1]), snapshot)
+
+        # Files are flushed when the router goes idle, or at least every flush_interval seconds while busy
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+        # forward() returns once no new LSA arrived for idle_timeout seconds, or after timeout seconds; None: never
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.last_change = time.monotonic()
+
+        # Number of LSAs and of LSA messages sent, for benchmarking
+        self.lsa_sent = 0
+        self.messages_sent = 0
+
+        # Number of SPF (dijkstra) runs, and seconds spent in them, for benchmarking
+        self.spf_runs = 0
+        self.spf_time = 0.0
+
+        # LSAs received, dropped as already seen, and flooded on to other links (once per link);
+        # messages dropped because their link is down or their format unknown
+        self.lsa_received = 0
+        self.lsa_dropped = 0
+        self.lsa_forwarded = 0
+        self.messages_dropped = 0
+
+        # Number of LSAs sent again for lack of an ack, and of ack messages sent, for benchmarking
+        self.retransmissions = 0
+        self.acks_sent = 0
+
+        # Bytes of routing messages (LSAs and acks) sent, for benchmarking
+        self.bytes_sent = 0
+
+        # Data messages forwarded, delivered here, and dropped (no route or TTL expired)
+        self.data_forwarded = 0
+        self.data_delivered = 0
+        self.data_dropped = 0
+
+        # Trace loggers of every category, see logger.enable_trace
+        for category in TRACE_CATEGORIES:
+            setattr(self, 'trace_' + category, get_tracer(category, vrid))
+
+
+    # Open the socket to the NFE
+    def open_socket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 
     # Send data to NFE
@@ -71,80 +222,204 @@ class VirtualRouter:
     def init(self):
 
         # Send 'init'
+        self.send(self.init_serialize())
+
+        # Wait for 'init-reply'
+        self.init_reply_parse(self.recv(4096))
+
+
+    # Serialize the init message
+    def init_serialize(self):
         data = struct.pack("!i", 1) # message type = 0x1
         data += struct.pack("!i", self.router_id) # router ID
-        self.send(data)
+        return data
 
-        # Wait for 'init-reply'
-        buffer = self.recv(4096)
-        message_type = struct.unpack("!i", buffer[0:4])[0] # message type, 0x4
+
+    # Parse the init-reply and learn the connected links, and their areas if the topology has areas
+    def init_reply_parse(self, buffer):
+        message_type = struct.unpack("!i", buffer[0:4])[0] # message type, 0x4 or 0xc
         nbr_links    = struct.unpack("!i", buffer[4:8])[0] # nbr links
+        self.area_routing = message_type == INIT_REPLY_AREAS
+        entry_length = 12 if self.area_routing else 8
 
         for i in range(nbr_links):
-            link_id   =  struct.unpack("!i", buffer[8*(i+1)  :8*(i+1)+4])[0] # link_id
-            link_cost =  struct.unpack("!i", buffer[8*(i+1)+4:8*(i+1)+8])[0] # link_cost
+            offset = 8 + entry_length * i
+            link_id   =  struct.unpack("!i", buffer[offset  :offset+4])[0] # link_id
+            link_cost =  struct.unpack("!i", buffer[offset+4:offset+8])[0] # link_cost
             self.neighbors.add(link_id)
             self.link_costs[link_id] = link_cost
+            self.link_areas[link_id] = struct.unpack("!i", buffer[offset+8:offset+12])[0] if self.area_routing else 0
+        self.areas = set(self.link_areas.values())
+
+
+    # Links of this router in an area that are up, LSAs of the area are flooded over them only
+    def area_links(self, area):
+        return [link_id for link_id in self.neighbors if self.link_areas[link_id] == area]
 
 
-    # Mark LSA as seen before
-    def mark_as_seen_before(self, other_lsa):
-        self.lsa_seen_before.add((other_lsa['router_id'], other_lsa['router_link_id'], other_lsa['router_link_cost']))
+    # An area border router has links in the backbone and in other areas
+    def is_area_border_router(self):
+        return 0 in self.areas and len(self.areas) > 1
 
 
-    # Check if this LSA is seen before
-    def seen_before(self, other_lsa):
-        return (other_lsa['router_id'], other_lsa['router_link_id'], other_lsa['router_link_cost']) in self.lsa_seen_before
+    # Follow the areas this router has links up in; with its backbone links down it stops being an area border router
+    def update_areas(self):
+        areas = set(self.link_areas[link_id] for link_id in self.neighbors)
+        if areas != self.areas:
+            self.areas = areas
+            self.graph_changed = True
 
 
-    # Update graph
-    def update_graph(self):
-        for link_id, vertices in self.links.items():
-            if len(vertices) == 2:
-                v1, v2 = tuple(vertices)
-                self.graph_add_link(v1, v2, link_id, self.link_costs[link_id])
+    # Number of LSAs in the databases of all attached areas, not counting withdrawals; safe to call from another thread
+    def lsdb_size(self):
+        return sum(1 for lsdb in list(self.lsdbs.values()) for sequence, cost, expires_at in list(lsdb.values()) if cost >= 0)
+
+
+    # Mark LSA as seen before, i.e. install it in the link state database of its area
+    def mark_as_seen_before(self, other_lsa, area):
+        key = (other_lsa['router_id'], other_lsa['router_link_id'])
+        lifetime = self.max_age - other_lsa['age']
+        if key[1] < 0 and other_lsa['router_link_cost'] < 0:
+            # a withdrawn summary is remembered for max_age however old it is, so copies of it still being flooded
+            # aren't taken for new ones once it would have aged out
+            lifetime = self.max_age
+        expires_at = time.monotonic() + lifetime
+        self.lsdbs[area][key] = [other_lsa['sequence'], other_lsa['router_link_cost'], expires_at]
+        self.schedule(lifetime, self.expire, area, key, expires_at)
+
+
+    # Check if this LSA is seen before, i.e. the database of its area already has this or a newer instance
+    def seen_before(self, other_lsa, area):
+        entry = self.lsdbs[area].get((other_lsa['router_id'], other_lsa['router_link_id']))
+        return entry is not None and other_lsa['sequence'] <= entry[0]
+
+
+    # Update the graph edge of one link from the routers advertising it
+    def update_link(self, link_id):
+        advertisers = self.links[link_id]
+        edge = self.link_edges.get(link_id)
+        if len(advertisers) == 2:
+            (u, cost_u), (v, cost_v) = advertisers.items()
+            if edge is not None and set(edge) != {u, v}:
+                self.graph_remove_link(*edge)
+            # both ends advertise the same cost once they have both seen a change
+            self.graph_add_link(u, v, link_id, max(cost_u, cost_v))
+            self.link_edges[link_id] = (u, v)
+        elif edge is not None:
+            self.graph_remove_link(*edge)
+            del self.link_edges[link_id]
 
 
     # Add a link to the graph
     def graph_add_link(self, u, v, link_id, link_cost):
         if u == v:
             return
+        if self.graph[u].get(v) == (link_id, link_cost):
+            return
         self.graph[u][v] = (link_id, link_cost)
         self.graph[v][u] = (link_id, link_cost)
+        self.graph_changed = True
+        self.topology_file.update((u, v), (link_id, link_cost))
+        self.topology_file.update((v, u), (link_id, link_cost))
+
+
+    # Remove a link from the graph, and routers left without links
+    def graph_remove_link(self, u, v):
+        del self.graph[u][v]
+        del self.graph[v][u]
+        for w in (u, v):
+            if not self.graph[w]:
+                del self.graph[w]
+        self.graph_changed = True
+        self.topology_file.remove((u, v))
+        self.topology_file.remove((v, u))
 
 
     # Serialize a LSA message
-    def LSA_serialize(self, sender_id, sender_link_id, router_id, router_link_id, router_link_cost):
-        data =  struct.pack("!i", 3) # messate type = 0x3
+    def LSA_serialize(self, sender_id, sender_link_id, router_id, router_link_id, router_link_cost, sequence, age):
+        data =  struct.pack("!i", LSA_SEQ) # messate type = 0x5
         data += struct.pack("!i", sender_id) # sender ID
         data += struct.pack("!i", sender_link_id) # sender link id
         data += struct.pack("!i", router_id) # router ID
         data += struct.pack("!i", router_link_id) # router link id
-        data += struct.pack("!i", router_link_cost) # router link cost
+        data += struct.pack("!i", router_link_cost) # router link cost, negative when the link is down
+        data += struct.pack("!i", sequence) # sequence number, higher is newer
+        data += struct.pack("!i", age) # seconds since the LSA was originated
         return data
 
 
     # Parse LSA bytes and returns a dict
     def LSA_parse(self, buffer):
         lsa = {}
-        lsa['message_type']     = struct.unpack("!i", buffer[0 : 4])[0] # message type, 0x3
+        lsa['message_type']     = struct.unpack("!i", buffer[0 : 4])[0] # message type, 0x3 or 0x5
         lsa['sender_id']        = struct.unpack("!i", buffer[4 : 8])[0] # sender ID
         lsa['sender_link_id']   = struct.unpack("!i", buffer[8 :12])[0] # sender link id
         lsa['router_id']        = struct.unpack("!i", buffer[12:16])[0] # router ID
         lsa['router_link_id']   = struct.unpack("!i", buffer[16:20])[0] # router link id
         lsa['router_link_cost'] = struct.unpack("!i", buffer[20:24])[0] # router link cost
+        if lsa['message_type'] == LSA_SEQ:
+            lsa['sequence']     = struct.unpack("!i", buffer[24:28])[0] # sequence number
+            lsa['age']          = struct.unpack("!i", buffer[28:32])[0] # age
+        else:
+            # plain LSAs from routers without sequence numbers are never superseded
+            lsa['sequence']     = 0
+            lsa['age']          = 0
         return lsa
 
+
+    # Serialize a packed LSA message, lsas are (router_id, router_link_id, router_link_cost, sequence, age)
+    def LSA_packed_serialize(self, sender_link_id, lsas):
+        data =  struct.pack("!i", LSA_PACKED) # message type = 0xa
+        data += struct.pack("!i", self.router_id) # sender ID
+        data += struct.pack("!i", sender_link_id) # sender link id
+        data += struct.pack("!i", PACKED_LSA_VERSION) # format version
+        data += struct.pack("!i", len(lsas)) # number of LSAs
+        for lsa in lsas:
+            data += struct.pack("!iiiii", *lsa) # one LSA, same fields as message type 0x5
+        return data
+
+
+    # Parse a packed LSA message into one dict per LSA, None if this router doesn't know the version
+    def LSA_packed_parse(self, buffer):
+        message_type, sender_id, sender_link_id, version, count = struct.unpack("!iiiii", buffer[0:20])
+        if version != PACKED_LSA_VERSION or 20 + 20 * count != len(buffer):
+            return None
+        lsas = []
+        for fields in struct.iter_unpack("!iiiii", buffer[20:]):
+            lsa = dict(zip(LSA_FIELDS, fields))
+            lsa['message_type'] = message_type
+            lsa['sender_id'] = sender_id
+            lsa['sender_link_id'] = sender_link_id
+            lsas.append(lsa)
+        return lsas
+
+
+    # Serialize an ack for several LSAs received over one link
+    def LSA_ACK_serialize(self, sender_link_id, acks):
+        data =  struct.pack("!i", LSA_ACK) # message type = 0x9
+        data += struct.pack("!i", self.router_id) # sender ID
+        data += struct.pack("!i", sender_link_id) # sender link id
+        for router_id, router_link_id, sequence in acks:
+            data += struct.pack("!iii", router_id, router_link_id, sequence) # one acknowledged LSA
+        return data
+
+
+    # Parse an ack, returns the link it came over and the acknowledged (router id, router link id, sequence)
+    def LSA_ACK_parse(self, buffer):
+        sender_link_id = struct.unpack("!i", buffer[8:12])[0]
+        return sender_link_id, list(struct.iter_unpack("!iii", buffer[12:]))
+
     
-    # Run dijkstra, returns the cost to target and next hop
-    def dijkstra(self, graph, source, target):
-        cost = defaultdict(lambda: float('inf'))
-        cost[source] = 0
-        parent = defaultdict(lambda: None)
-        parent[source] = -1
+    # Run dijkstra from source, returns the cost to every reachable router and all of its
+    # equal-cost next hops (the neighbours of source that start one of the shortest paths)
+    def dijkstra(self, graph, source):
+        self.spf_runs += 1
+        started = time.perf_counter()
+        cost = {source: 0}
+        next_hops = {source: set()}
         pq = [(0, source)]
         visited = set()
-        
+
         while pq:
             current_cost, u = heapq.heappop(pq) # extract min
 
@@ -152,132 +427,823 @@ class VirtualRouter:
                 continue
             visited.add(u)
 
-            if u == target: # Early stop
-                break
-
-            for v in graph[u]:
-                new_cost = current_cost + graph[u][v][1]
-                if new_cost < cost[v]:
-                    parent[v] = u
+            for v, (_, link_cost) in graph[u].items():
+                new_cost = current_cost + link_cost
+                # paths through u start with u itself when u is a neighbour of source
+                hops = next_hops[u] if u != source else {v}
+                if new_cost < cost.get(v, float('inf')):
                     cost[v] = new_cost
+                    next_hops[v] = set(hops)
                     heapq.heappush(pq, (new_cost, v))
+                elif new_cost == cost[v] and v not in visited:
+                    next_hops[v] |= hops # another predecessor on an equal-cost path
 
-        u, v = parent[target], target
-        while u != source and u is not None:
-            v = u
-            u = parent[u] # Walk backward to find the next hop
+        elapsed = time.perf_counter() - started
+        self.spf_time += elapsed
+        self.trace_spf.debug('SPF over %d routers in %.3f ms', len(graph), 1000 * elapsed)
+        return cost, next_hops
 
-        return cost[target], v
 
+    # Update the graph and table based on the LSA received in area
+    def update_from_LSA(self, lsa, area):
 
-    # Update the graph and table based on the LSA received
-    def update_from_LSA(self, lsa):
+        # Summaries don't change the graph, only the routes to other areas
+        link_id = lsa['router_link_id']
+        if link_id < 0:
+            self.summaries_changed = True
+            return
 
         # Update the graph
-        self.links[lsa['router_link_id']].add(lsa['router_id'])
-        self.links[lsa['sender_link_id']].add(lsa['sender_id'])
-        self.links[lsa['sender_link_id']].add(self.router_id)
-        self.link_costs[lsa['router_link_id']] = lsa['router_link_cost']
-        self.update_graph()
+        self.link_areas[link_id] = area
+        if lsa['router_link_cost'] >= 0:
+            self.links[link_id][lsa['router_id']] = lsa['router_link_cost']
+        else:
+            self.links[link_id].pop(lsa['router_id'], None)
+        self.update_link(link_id)
+        self.trace_lsdb.debug('link %d advertised by %s', link_id, self.links[link_id])
+
+
+    # Recompute the routing table if the graph, or the summaries of other areas, changed
+    def update_routing_table(self):
+        if not self.graph_changed and not self.summaries_changed:
+            return
+        if self.graph_changed:
+            # one SPF per attached area, paths to the routers of an area stay within it
+            self.spf = {}
+            for area in self.areas or {0}:
+                graph = self.area_graph(area)
+                if self.router_id in graph:
+                    self.spf[area] = self.dijkstra(graph, self.router_id)
+                else:
+                    self.spf[area] = ({}, {}) # no links left, nothing is reachable
+        self.graph_changed = self.summaries_changed = False
+
+        # The cheapest route over all attached areas, next hops are kept sorted so equal sets compare equal
+        best = {}
+        for costs, next_hops in self.spf.values():
+            for target, cost in costs.items():
+                if target == self.router_id:
+                    continue
+                entry = best.get(target)
+                if entry is None or cost < entry[0]:
+                    best[target] = (cost, set(next_hops[target]))
+                elif cost == entry[0]:
+                    entry[1].update(next_hops[target])
+        routes = {target: (cost, tuple(sorted(hops))) for target, (cost, hops) in best.items()}
+        if self.area_routing:
+            routes.update(self.inter_area_routes(routes))
+
+        for target, entry in routes.items():
+            if self.routing_table.get(target) != entry:
+                self.last_change = time.monotonic()
+                self.routing_table[target] = entry
+                self.routingtable_file.update(target, (entry[1], entry[0]))
+                self.trace_routes.info('route to %d: cost %d via %s', target, entry[0], entry[1])
+
+        # Routers that became unreachable or left the graph
+        for target in [target for target in self.routing_table if target not in routes]:
+            self.remove_route(target)
+
+        self.compile_fib()
+        if (self.is_area_border_router() or self.summaries) and not self.summaries_due:
+            self.summaries_due = True
+            self.summaries_due_since = time.monotonic()
+            delay = self.SUMMARY_DELAY
+            if self.summarized_at is not None:
+                delay = max(delay, self.summarized_at + self.summary_hold - time.monotonic())
+            self.schedule(delay, self.originate_summaries)
+
+
+    # The graph of one attached area; without areas everything is in the backbone. The graph can still hold links
+    # of an area this router was attached to before its links there went down
+    def area_graph(self, area):
+        if not self.area_routing:
+            return dict(self.graph)
+        graph = {}
+        for u, edges in self.graph.items():
+            area_edges = {v: edge for v, edge in edges.items() if self.link_areas.get(edge[0]) == area}
+            if area_edges:
+                graph[u] = area_edges
+        return graph
+
+
+    # Link id of the summary LSA for the router ids first..last, and back
+    def summary_link_id(self, first, last):
+        return -(first * SUMMARY_SPAN + last - first)
+
+    def summary_range(self, link_id):
+        first, span = divmod(-link_id, SUMMARY_SPAN)
+        return first, first + span
+
+
+    # Routes to the routers of other areas, through the area border router advertising the cheapest summary.
+    # Routers in the backbone use the summaries of the backbone, the others those of their own area;
+    # a router reachable within the attached areas is never routed through a summary
+    def inter_area_routes(self, routes):
+        area = 0 if 0 in self.areas or not self.areas else min(self.areas)
+        costs, next_hops = self.spf.get(area, ({}, {}))
+        best = {}
+        for (router_id, link_id), (sequence, cost, expires_at) in self.lsdbs[area].items():
+            if link_id >= 0 or cost < 0 or router_id == self.router_id or router_id not in costs:
+                continue
+            first, last = self.summary_range(link_id)
+            total = costs[router_id] + cost
+            for target in range(first, last + 1):
+                if target in routes or target == self.router_id:
+                    continue
+                if target not in best or total < best[target][0]:
+                    best[target] = (total, set(next_hops[router_id]))
+                elif total == best[target][0]:
+                    best[target][1].update(next_hops[router_id])
+        return {target: (cost, tuple(sorted(hops))) for target, (cost, hops) in best.items()}
+
+
+    # As an area border router, summarize into the backbone the routers reachable within the other attached areas, and into
+    # every other attached area the routers it has a route to outside of it. A summary covers a run of router ids that only
+    # skips over routers this router reaches within its areas, never one it didn't learn of, at the cost of its route to the
+    # farthest one; a router there adds its cost to this router. Only changes are originated unless refreshing, and while
+    # they keep coming the hold time before the next origination doubles; a router that is no longer an area border router
+    # withdraws its summaries
+    def originate_summaries(self, refresh=False):
+        now = time.monotonic()
+        if not refresh and now - self.summaries_due_since < self.SUMMARY_HOLD_MAX and (
+                now - self.last_change < self.SUMMARY_DELAY or any(self.retransmit.values())):
+            # the routing table is still changing, or the LSAs this router flooded last haven't been acknowledged
+            self.schedule(self.SUMMARY_DELAY, self.originate_summaries)
+            return
+        self.summaries_due = False
+        areas = self.areas if self.is_area_border_router() else set()
+        members = {area: self.spf.get(area, ({}, {}))[0] for area in areas}
+        # routers reached within an attached area; summaries of other area border routers don't count, or two of them could
+        # keep summarizing a router that's gone because the other one does
+        known = {self.router_id}.union(*members.values())
+
+        wanted = {}
+        for area in areas:
+            if area == 0:
+                # routers with a link up in the backbone, whether SPF reaches them yet or not, aren't summarized into it
+                backbone = {router_id for (router_id, link_id), (sequence, cost, expires_at) in self.lsdbs[0].items()
+                            if link_id >= 0 and cost >= 0}
+                targets = {target for other in areas if other != 0 for target in members[other] if target not in backbone}
+            else:
+                targets = set(self.routing_table) - set(members[area])
+            costs = {target: self.routing_table[target][0] for target in targets if target in self.routing_table}
+            ids = sorted(costs)
+            first = 0
+            for i, target in enumerate(ids):
+                if i + 1 == len(ids) or ids[i + 1] - ids[first] >= SUMMARY_SPAN or any(
+                        gap not in known for gap in range(target + 1, ids[i + 1])):
+                    wanted[(area, ids[first], target)] = max(costs[ids[j]] for j in range(first, i + 1))
+                    first = i + 1
+
+        changes = defaultdict(list)
+        for (area, first, last), cost in wanted.items():
+            if refresh or self.summaries.get((area, first, last)) != cost:
+                changes[area].append((first, last, cost))
+        for area, first, last in self.summaries:
+            if (area, first, last) not in wanted:
+                changes[area].append((first, last, -1))
+        if changes and not refresh:
+            if self.summarized_at is not None and now - self.summarized_at < 2 * self.SUMMARY_HOLD_MAX:
+                self.summary_hold = min(self.SUMMARY_HOLD_MAX, 2 * self.summary_hold)
+            else:
+                self.summary_hold = self.SUMMARY_DELAY
+            self.summarized_at = now
+        self.summaries = wanted
+        for area, summaries in changes.items():
+            self.originate_summary_LSAs(area, summaries)
+
+
+    # Originate summary LSAs into one area, [(first router id, last router id, cost)]; a negative cost withdraws a range.
+    # Withdrawals are not refreshed, they start out almost aged and soon expire everywhere including here
+    def originate_summary_LSAs(self, area, summaries):
+        self.sequence += 1
+        self.last_change = time.monotonic()
+        lsdb = self.lsdbs[area]
+        lsas = []
+        for first, last, cost in summaries:
+            key = (self.router_id, self.summary_link_id(first, last))
+            if cost >= 0:
+                lsdb[key] = [self.sequence, cost, float('inf')]
+                age = 0
+            else:
+                lsdb[key] = [self.sequence, cost, time.monotonic() + self.SUMMARY_WITHDRAW_HOLD]
+                self.schedule(self.SUMMARY_WITHDRAW_HOLD, self.expire, area, key, lsdb[key][2])
+                age = int(self.max_age - self.SUMMARY_WITHDRAW_HOLD)
+            lsas.append(key + (cost, self.sequence, age))
+        self.propagate(lsas, self.area_links(area))
+
+
+    # Compile the routing table into the FIB; a new list, so another thread sending data never sees half of it
+    def compile_fib(self):
+        fib = [None] * (max(self.routing_table, default=0) + 1)
+        neighbours = self.graph.get(self.router_id, {})
+        for target, (cost, next_hops) in self.routing_table.items():
+            fib[target] = tuple(neighbours[hop][0] for hop in next_hops)
+        self.fib = fib
+
+
+    def remove_route(self, target):
+        if self.routing_table.pop(target, None) is not None:
+            self.last_change = time.monotonic()
+            self.routingtable_file.remove(target)
+            self.trace_routes.info('route to %d removed', target)
+
+
+    # Pick one of the equal-cost next hops to target for a flow, None if target is unreachable.
+    # The flow key is a tuple of ints, e.g. (src, dst, src port, dst port); every packet of a flow
+    # takes the same path, and different flows spread over the parallel paths
+    def select_next_hop(self, target, flow_key):
+        entry = self.routing_table.get(target)
+        if entry is None:
+            return None
+        next_hops = entry[1]
+        return next_hops[self.flow_path(flow_key, len(next_hops))]
+
+
+    # Which of count equal-cost paths a flow takes
+    def flow_path(self, flow_key, count):
+        if count == 1:
+            return 0
+        # the router id seeds the hash, otherwise every router on the way would split flows the same way
+        flow_hash = zlib.crc32(struct.pack("!{}i".format(len(flow_key) + 1), self.router_id, *flow_key))
+        return flow_hash % count
+
+
+    # Send a data message from this router to destination, the payload is opaque bytes
+    def send_data(self, destination, packet_id=0, payload=b'', ttl=DATA_TTL):
+        self.forward_data(self.data_message(destination, packet_id, payload, ttl))
+
+
+    # A data message from this router to destination, as forward_data takes it; sent to this router's socket from another
+    # thread, the router sends it on from its own thread
+    def data_message(self, destination, packet_id=0, payload=b'', ttl=DATA_TTL):
+        return DATA_HEADER.pack(DATA, self.router_id, 0, self.router_id, destination, ttl, 0, packet_id, time.monotonic()) + payload
+
+
+    # Deliver a data message, or forward it one hop along the FIB
+    def forward_data(self, buffer):
+        _, _, _, source, destination, ttl, hops, packet_id, sent_at = DATA_HEADER.unpack_from(buffer)
+        if destination == self.router_id:
+            self.data_delivered += 1
+            if self.data_sink is not None:
+                self.data_sink(self.router_id, source, packet_id, hops, sent_at)
+            return
 
-        print(self.links)
+        fib = self.fib
+        links = fib[destination] if 0 <= destination < len(fib) else None
+        if links is None or ttl <= 0:
+            self.data_dropped += 1
+            return
+        # every message between the same two routers takes the same path
+        link_id = links[self.flow_path((source, destination), len(links))]
 
-        if len(self.graph) > 0:
-            self.update_topology_file()
+        data = bytearray(buffer)
+        DATA_HEADER.pack_into(data, 0, DATA, self.router_id, link_id, source, destination, ttl - 1, hops + 1, packet_id, sent_at)
+        self.send(data)
+        self.data_forwarded += 1
 
-        graph = dict(self.graph)
-        vertices = graph.keys()
+    
+    # Propagate LSAs to other routers, lsas are (router_id, router_link_id, router_link_cost, sequence, age)
+    def propagate(self, lsas, links=None):
+        for link_id in (self.neighbors if links is None else links):
+            self.queue_LSAs(link_id, lsas)
 
-        try:
-            for target in vertices:
-                if target != self.router_id:
-                    # Update the routing table
-                    cost, next_hop = self.dijkstra(graph, self.router_id, target)
-                    self.routing_table[target] = (cost, next_hop)
-        except KeyError:
-            pass
 
-        if len(self.routing_table) > 0:
-            self.update_routingtable_file()
+    # Queue LSAs for a link, they go out together once the messages at hand are handled
+    def queue_LSAs(self, link_id, lsas):
+        queue = self.send_queues[link_id]
+        for lsa in lsas:
+            key = (lsa[0], lsa[1])
+            queued = queue.get(key)
+            if queued is None or queued[3] <= lsa[3]:
+                queue[key] = lsa
 
-    
-    # Propagate the LSA to other routers
-    def propagate(self, router_id, router_link_id, router_link_cost):
-        for link_id in self.neighbors:
-            lsa_bytes = self.LSA_serialize(self.router_id, link_id, router_id, router_link_id, router_link_cost)
-            print('Sending(F):{}'.format(self.LSA_str(self.LSA_parse(lsa_bytes))))
-            self.send(lsa_bytes)
+
+    # Send every queued LSA
+    def flush_send_queues(self):
+        if not self.send_queues:
+            return
+        send_queues, self.send_queues = self.send_queues, defaultdict(dict)
+        for link_id, queue in send_queues.items():
+            if link_id in self.neighbors:
+                self.send_LSAs(link_id, list(queue.values()))
+
+
+    # Send LSAs over one link, as few packed messages as possible unless the router at the other end
+    # only understands single LSAs, and keep sending them until that router acknowledges them
+    def send_LSAs(self, link_id, lsas, again=False):
+        if not lsas:
+            return
+        if self.packed and link_id not in self.single_lsa_links:
+            for i in range(0, len(lsas), self.PACKED_LSA_MAX):
+                data = self.LSA_packed_serialize(link_id, lsas[i:i + self.PACKED_LSA_MAX])
+                self.send(data)
+                self.messages_sent += 1
+                self.bytes_sent += len(data)
+        else:
+            for lsa in lsas:
+                data = self.LSA_serialize(self.router_id, link_id, *lsa)
+                self.send(data)
+                self.messages_sent += 1
+                self.bytes_sent += len(data)
+        if self.trace_sent.isEnabledFor(logging.DEBUG):
+            for lsa in lsas:
+                self.trace_sent.debug(LSA_SENT_TRACE_FORMAT, self.router_id, link_id, *lsa)
+        now = time.monotonic()
+        pending = self.retransmit[link_id]
+        for lsa in lsas:
+            pending[(lsa[0], lsa[1])] = (lsa[3], now, again)
+        self.lsa_sent += len(lsas)
+        if link_id not in self.retransmit_timers:
+            self.retransmit_timers.add(link_id)
+            self.schedule(self.retransmit_timeout(link_id), self.retransmit_link, link_id)
+
+
+    # Seconds an LSA sent over a link waits for its ack
+    def retransmit_timeout(self, link_id):
+        return self.retransmit_timeouts.get(link_id, self.RETRANSMIT_INTERVAL)
+
+
+    # An ack arrived round_trip seconds after the LSA it acknowledges was sent, only once: like TCP, the timeout
+    # is the smoothed round trip time plus a multiple of its variation, though both follow faster, since the round trip
+    # is mostly the time LSAs wait at busy routers and changes as a flood starts and ends. None only resets the
+    # timeout after backing off
+    def measure_round_trip(self, link_id, round_trip):
+        estimate = self.round_trips.get(link_id)
+        if estimate is None:
+            estimate = self.round_trips[link_id] = [round_trip, round_trip / 2]
+        elif round_trip is not None:
+            estimate[1] = 0.5 * estimate[1] + 0.5 * abs(estimate[0] - round_trip)
+            estimate[0] = 0.75 * estimate[0] + 0.25 * round_trip
+        self.retransmit_timeouts[link_id] = min(self.RETRANSMIT_MAX, max(self.RETRANSMIT_MIN, estimate[0] + 2 * estimate[1]))
+
+
+    # Send the latest instance of the LSAs over a link that weren't acknowledged in time, RETRANSMIT_BATCH at most,
+    # and back off: the link's timeout doubles until acks come in again
+    def retransmit_link(self, link_id):
+        self.retransmit_timers.discard(link_id)
+        pending = self.retransmit.get(link_id)
+        if not pending or link_id not in self.neighbors:
+            return
+        now = time.monotonic()
+        timeout = self.retransmit_timeout(link_id)
+        overdue = sorted((sent_at, key) for key, (sequence, sent_at, again) in pending.items() if now - sent_at >= timeout)
+        if self.send_again(link_id, overdue, now):
+            timeout = self.retransmit_timeouts[link_id] = min(self.RETRANSMIT_MAX, 2 * timeout)
+        if pending and link_id not in self.retransmit_timers:
+            self.retransmit_timers.add(link_id)
+            if len(overdue) > self.RETRANSMIT_BATCH:
+                # the rest goes out in the next round
+                delay = timeout
+            else:
+                delay = min(sent_at for sequence, sent_at, again in pending.values()) + timeout - now
+            self.schedule(delay, self.retransmit_link, link_id)
+
+
+    # The router at the other end of link_id has this or a newer instance of the LSA; returns the entry it had
+    # in the retransmission list, None if there was none
+    def acknowledged(self, link_id, router_id, router_link_id, sequence):
+        pending = self.retransmit.get(link_id)
+        if not pending:
+            return None
+        entry = pending.get((router_id, router_link_id))
+        if entry is not None and sequence >= entry[0]:
+            del pending[(router_id, router_link_id)]
+            return entry
+        return None
+
+
+    # Like TCP's fast retransmit: the router at the other end acknowledged an LSA sent at delivered, and the NFE
+    # doesn't reorder the messages of a link, so the LSAs sent before it are lost and sent again right away, without
+    # backing off
+    def retransmit_lost(self, link_id, delivered):
+        pending = self.retransmit.get(link_id)
+        if not pending:
+            return
+        lost = sorted((sent_at, key) for key, (sequence, sent_at, again) in pending.items() if sent_at < delivered)
+        self.send_again(link_id, lost, time.monotonic())
+
+
+    # Send the latest instance of the first RETRANSMIT_BATCH of [(sent at, key)] pending on a link again,
+    # returns how many were sent
+    def send_again(self, link_id, overdue, now):
+        pending = self.retransmit[link_id]
+        lsas = []
+        for sent_at, key in overdue[:self.RETRANSMIT_BATCH]:
+            entry = self.lsdbs[self.link_areas[link_id]].get(key)
+            if entry is None:
+                del pending[key] # aged out in the meantime
+                continue
+            lsas.append((key[0], key[1], entry[1], entry[0], self.LSA_age(entry[2], now)))
+        self.retransmissions += len(lsas)
+        self.send_LSAs(link_id, lsas, again=True)
+        return len(lsas)
+
+
+    # Acknowledge a received LSA; acks for the same link are batched into one message
+    def acknowledge(self, lsa):
+        link_id = lsa['sender_link_id']
+        acks = self.pending_acks[link_id]
+        acks.append((lsa['router_id'], lsa['router_link_id'], lsa['sequence']))
+        if len(acks) >= self.ACK_BATCH:
+            self.send_acks(link_id)
+        elif len(acks) == 1:
+            self.schedule(self.ACK_DELAY, self.send_acks, link_id)
+
+
+    # Send the waiting acks of one link
+    def send_acks(self, link_id):
+        acks = self.pending_acks.pop(link_id, None)
+        if not acks or link_id not in self.neighbors:
+            return
+        data = self.LSA_ACK_serialize(link_id, acks)
+        self.send(data)
+        self.acks_sent += 1
+        self.bytes_sent += len(data)
+
+
+    # Handle an ack from a neighbour. The latest LSA it acknowledges that was sent only once measures the round trip time,
+    # and the LSAs sent before that one were lost
+    def receive_ack(self, buffer):
+        link_id, acks = self.LSA_ACK_parse(buffer)
+        if link_id not in self.neighbors:
+            return
+        delivered = None
+        progress = False
+        for router_id, router_link_id, sequence in acks:
+            entry = self.acknowledged(link_id, router_id, router_link_id, sequence)
+            if entry is None:
+                continue
+            progress = True
+            # an ack of an LSA sent again may be for any of its copies
+            if not entry[2]:
+                delivered = entry[1] if delivered is None else max(delivered, entry[1])
+        if delivered is not None:
+            self.measure_round_trip(link_id, time.monotonic() - delivered)
+            self.retransmit_lost(link_id, delivered)
+        elif progress and link_id in self.round_trips:
+            # the link works again, stop backing off
+            self.measure_round_trip(link_id, None)
+
+
+    # Originate new instances of the LSAs of some of this router's links, [(link id, cost)]; a negative cost withdraws a link.
+    # Each LSA is flooded in the area of its link only
+    def originate(self, links):
+        if not links:
+            return
+        self.sequence += 1
+        self.last_change = time.monotonic()
+        lsas = []
+        by_area = defaultdict(list)
+        for link_id, link_cost in links:
+            area = self.link_areas[link_id]
+            self.lsdbs[area][(self.router_id, link_id)] = [self.sequence, link_cost, float('inf')] # own LSAs are refreshed, never expire
+            lsas.append((self.router_id, link_id, link_cost, self.sequence, 0))
+            by_area[area].append(lsas[-1])
+        for area, area_lsas in by_area.items():
+            self.propagate(area_lsas, self.area_links(area))
+        for lsa in lsas:
+            self.update_from_LSA(dict(zip(LSA_FIELDS, lsa)), self.link_areas[lsa[1]])
+        self.update_routing_table()
+
+
+    # Another router still floods an LSA of ours from before a restart; continue numbering after it
+    def receive_own_LSA(self, lsa, area):
+        if lsa['sequence'] <= self.sequence:
+            self.lsa_dropped += 1
+            self.trace_dropped.debug(LSA_TRACE_FORMAT, lsa)
+            return
+        self.sequence = lsa['sequence']
+        link_id = lsa['router_link_id']
+        if link_id < 0:
+            first, last = self.summary_range(link_id)
+            self.originate_summary_LSAs(area, [(first, last, self.summaries.get((area, first, last), -1))])
+        else:
+            self.originate([(link_id, self.link_costs[link_id] if link_id in self.neighbors else -1)])
+
+
+    # The NFE reports that one of this router's links went down
+    def link_down(self, link_id):
+        if link_id not in self.neighbors:
+            return
+        self.trace_link.info('link %d down', link_id)
+        self.neighbors.discard(link_id)
+        # nothing gets through anymore, the other end starts over from send_database when the link comes back
+        self.retransmit.pop(link_id, None)
+        self.retransmit_timeouts.pop(link_id, None)
+        self.round_trips.pop(link_id, None)
+        self.pending_acks.pop(link_id, None)
+        self.update_areas()
+        self.originate([(link_id, -1)])
+
+
+    # The NFE reports a new cost for one of this router's links, which may have been down until now
+    def link_cost_changed(self, link_id, link_cost):
+        was_up = link_id in self.neighbors
+        self.trace_link.info('link %d %s, cost %d', link_id, 'cost changed' if was_up else 'up', link_cost)
+        self.neighbors.add(link_id)
+        self.link_costs[link_id] = link_cost
+        self.update_areas()
+        self.originate([(link_id, link_cost)])
+        if not was_up:
+            # whatever changed while the link was down, the router at the other end hasn't seen it
+            self.send_database(link_id)
+
+
+    # Send every LSA in the database of the link's area over one link
+    def send_database(self, link_id):
+        now = time.monotonic()
+        lsdb = self.lsdbs[self.link_areas[link_id]]
+        self.queue_LSAs(link_id, [(router_id, router_link_id, cost, sequence, self.LSA_age(expires_at, now))
+                                 for (router_id, router_link_id), (sequence, cost, expires_at) in lsdb.items()])
+
+
+    # The router at the other end of a link sent single LSAs, or packed LSAs of a version this router doesn't
+    # know: send it single LSAs from now on, starting with the database it couldn't read so far
+    def use_single_LSAs(self, link_id):
+        if not self.packed or link_id in self.single_lsa_links or link_id not in self.neighbors:
+            return
+        self.single_lsa_links.add(link_id)
+        self.send_database(link_id)
+
+
+    # Seconds since an LSA in the database was originated, own LSAs other than withdrawn summaries are always new
+    def LSA_age(self, expires_at, now):
+        return 0 if expires_at == float('inf') else int(self.max_age - (expires_at - now))
+
+
+    # Run callback(*args) in delay seconds
+    def schedule(self, delay, callback, *args):
+        deadline = time.monotonic() + delay
+        heapq.heappush(self.timers, (deadline, next(self.timer_order), callback, args))
+        if self.timers[0][0] == deadline:
+            self.timer_armed(deadline)
+
+
+    # Called when a timer became the earliest one; the socket loop looks at the heap anyway
+    def timer_armed(self, deadline):
+        pass
+
+
+    # Run every timer that is due
+    def run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+
+    # Seconds until the next timer is due, None if there is none
+    def next_timer_delay(self):
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - time.monotonic())
+
+
+    # Re-originate this router's LSAs so other routers don't age them out
+    def refresh(self):
+        self.originate([(link_id, self.link_costs[link_id]) for link_id in self.neighbors])
+        if self.is_area_border_router():
+            self.originate_summaries(refresh=True)
+        self.schedule(self.refresh_interval, self.refresh)
+
+
+    # An LSA reached max age without being refreshed; expires_at tells whether a newer instance arrived since
+    def expire(self, area, key, expires_at):
+        lsdb = self.lsdbs[area]
+        entry = lsdb.get(key)
+        if entry is None or entry[2] != expires_at:
+            return
+        router_id, link_id = key
+        del lsdb[key]
+        if link_id < 0:
+            # routes never use withdrawn summaries
+            self.summaries_changed = self.summaries_changed or entry[1] >= 0
+        elif self.links[link_id].pop(router_id, None) is not None:
+            self.update_link(link_id)
+        self.update_routing_table()
 
 
     # Get a string representation of LSA
     def LSA_str(self, lsa):
-        fmt = 'SID({sender_id}),SLID({sender_link_id}),RID({router_id}),RLID({router_link_id}),LC({router_link_cost})'
-        return fmt.format(**lsa)
+        return LSA_TRACE_FORMAT % lsa
+
+
+    # Current value of every counter
+    def counters(self):
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+
+    # Write the counters, one per line
+    def dump_counters(self, out=sys.stderr):
+        for name, value in self.counters().items():
+            print('router {} {}: {}'.format(self.router_id, name, round(value, 6)), file=out)
+        out.flush()
     
 
-    # Update the topology into file
-    def update_topology_file(self):
-        temp = ''
-        if self.topology_update_buffer != '':
-            temp += '\n'
-        temp += 'TOPOLOGY'
-        entries = []
-        for router1 in self.graph:
-            for router2 in self.graph[router1]:
-                entries.append((router1, router2, self.graph[router1][router2][0], self.graph[router1][router2][1]))
-        entries.sort()
-        for entry in entries:
-            temp += '\nrouter:{},router:{},linkid:{},cost:{}'.format(*entry)
-        if self.topology_update_buffer != temp:
-            self.topology_update_buffer = temp
-            self.topology_file.info(self.topology_update_buffer)
-
-
-    # Update the routing table file
-    def update_routingtable_file(self):
-        temp = ''
-        if self.routingtable_update_buffer != '':
-            temp += '\n'
-        temp += 'ROUTING'
-        entries = []
-        for dest, (total_cost, next_hop) in self.routing_table.items():
-            entries.append((dest, next_hop, total_cost))
-        entries.sort()
-        for entry in entries:
-            temp += '\n{}:{},{}'.format(*entry)
-        if self.routingtable_update_buffer != temp:
-            self.routingtable_update_buffer = temp
-            self.routingtable_file.info(self.routingtable_update_buffer)
-
-
-    # Forwarding phase
-    def forward(self):
+    # Write pending topology and routing table changes to the files
+    def flush_files(self):
+        self.topology_file.flush()
+        self.routingtable_file.flush()
+        self.last_flush = time.monotonic()
+
+
+    # Flush if the files haven't been written for flush_interval seconds
+    def flush_files_if_due(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush_files()
+
 
-        # Initial broadcast
-        for link_id in self.neighbors:
-            lsa_bytes = self.LSA_serialize(self.router_id, link_id, self.router_id, link_id, self.link_costs[link_id])
-            print('Sending(E):{}'.format(self.LSA_str(self.LSA_parse(lsa_bytes))))
-            self.send(lsa_bytes)
-        
-        while True:
+    # Forwarding phase, returns the exit status: 0 once the router is idle, 1 on timeout
+    def forward(self):
+        start = time.monotonic()
+        self.broadcast()
+        try:
+            while not self.idle():
+                if self.timeout is not None and time.monotonic() - start >= self.timeout:
+                    return 1
+                self.forward_once()
+            return 0
+        finally:
+            self.flush_files()
+
+
+    # Wait for one message, or the next timer, and handle it
+    def forward_once(self):
+        # wait for the next timer at most; a receive timeout means nothing arrived for a while, i.e. the router is idle
+        delay = self.next_timer_delay()
+        timeout = self.flush_interval if delay is None else min(self.flush_interval, delay)
+        if self.idle_timeout is not None:
+            timeout = min(timeout, self.idle_timeout)
+        # a zero timeout would make the socket non-blocking
+        self.sock.settimeout(max(0.001, timeout))
+        try:
             buffer = self.recv(4096)
-            lsa = self.LSA_parse(buffer)
-            print('Received:{}'.format(self.LSA_str(lsa)))
+        except socket.timeout:
+            self.flush_files()
+            self.run_timers()
+            self.flush_send_queues()
+            return
+        self.receive(buffer)
+        # handle what else arrived meanwhile first, so the LSAs it all triggers go out together
+        self.receive_waiting(self.RECEIVE_BATCH - 1)
+        self.flush_files_if_due()
+        self.run_timers()
+        self.flush_send_queues()
+
+
+    # No new LSA for idle_timeout seconds, the routing table unchanged since, and nothing left to send, acknowledge or summarize
+    def idle(self):
+        if self.idle_timeout is None or time.monotonic() - self.last_change < self.idle_timeout:
+            return False
+        return not self.has_pending()
+
+
+    # Something is waiting to be sent, acknowledged, retransmitted or summarized
+    def has_pending(self):
+        return bool(self.send_queues) or any(self.pending_acks.values()) or any(self.retransmit.values()) or self.summaries_due
+
+
+    # Handle up to count messages that are already waiting on the socket
+    def receive_waiting(self, count):
+        self.sock.setblocking(False)
+        try:
+            for _ in range(count):
+                try:
+                    buffer = self.recv(4096)
+                except BlockingIOError:
+                    return
+                self.receive(buffer)
+        finally:
+            # sends must not fail with a full send buffer
+            self.sock.setblocking(True)
+
+
+    # Initial broadcast of this router's own links
+    def broadcast(self):
+        self.refresh()
+        self.flush_send_queues()
+
+
+    # Handle one message received from the NFE
+    def receive(self, buffer):
+        message_type = struct.unpack("!i", buffer[0:4])[0]
+        if message_type == LINK_DOWN:
+            self.link_down(struct.unpack("!i", buffer[4:8])[0])
+            return
+        if message_type == LINK_COST:
+            self.link_cost_changed(*struct.unpack("!ii", buffer[4:12]))
+            return
+        if message_type == LSA_ACK:
+            self.receive_ack(buffer)
+            return
+        if message_type == DATA:
+            self.forward_data(buffer)
+            return
+        if message_type not in (LSA, LSA_SEQ, LSA_PACKED) or not valid_message_length(message_type, len(buffer)):
+            self.messages_dropped += 1
+            self.trace_dropped.debug('message of type %d and %d bytes, this router runs link state', message_type, len(buffer))
+            return
+
+        link_id = struct.unpack("!i", buffer[8:12])[0]
+        if link_id not in self.neighbors:
+            # still in flight when the link went down
+            self.messages_dropped += 1
+            self.trace_dropped.debug('message of type %d from link %d that is down', message_type, link_id)
+            return
+        # LSAs belong to the area of the link they arrive over, and are flooded within it only
+        area = self.link_areas[link_id]
+
+        if message_type == LSA_PACKED:
+            lsas = self.LSA_packed_parse(buffer)
+            if lsas is None:
+                self.messages_dropped += 1
+                self.trace_dropped.debug('packed LSAs of unknown version from link %d', link_id)
+                self.use_single_LSAs(link_id)
+                return
+        else:
+            lsas = [self.LSA_parse(buffer)]
+            self.use_single_LSAs(link_id)
+
+        self.lsa_received += len(lsas)
+        new_lsas = []
+        newer_lsas = [] # instances the neighbour is behind on
+        for lsa in lsas:
+            self.trace_received.debug(LSA_TRACE_FORMAT, lsa)
+            self.acknowledge(lsa)
+            # a neighbour flooding the instance we sent it has it, as good as an ack
+            self.acknowledged(link_id, lsa['router_id'], lsa['router_link_id'], lsa['sequence'])
+
+            if lsa['router_id'] == self.router_id:
+                self.receive_own_LSA(lsa, area)
+                continue
 
             # Drop LSA if it was seen before, otherwise add to record
-            if self.seen_before(lsa):
-                print('Dropping:{}'.format(self.LSA_str(lsa)))
+            if self.seen_before(lsa, area):
+                self.lsa_dropped += 1
+                self.trace_dropped.debug(LSA_TRACE_FORMAT, lsa)
+                entry = self.lsdbs[area][(lsa['router_id'], lsa['router_link_id'])]
+                if lsa['sequence'] < entry[0]:
+                    newer_lsas.append((lsa['router_id'], lsa['router_link_id'], entry[1], entry[0], self.LSA_age(entry[2], time.monotonic())))
                 continue
 
-            self.mark_as_seen_before(lsa)
+            self.mark_as_seen_before(lsa, area)
+            new_lsas.append(lsa)
+
+        self.queue_LSAs(link_id, newer_lsas)
+        if new_lsas:
+            self.last_change = time.monotonic()
 
-            # Forward the LSA to neighbors, then update this router's states using this LSA, 
-            self.propagate(lsa['router_id'], lsa['router_link_id'], lsa['router_link_cost'])
-            self.update_from_LSA(lsa)
+        # Forward the new LSAs to neighbors in the same area except the one they came from, it has them already;
+        # then update this router's states using them
+        links = [link for link in self.area_links(area) if link != link_id]
+        self.propagate([tuple(lsa[field] for field in LSA_FIELDS) for lsa in new_lsas], links)
+        self.lsa_forwarded += len(new_lsas) * len(links)
+        for lsa in new_lsas:
+            self.update_from_LSA(lsa, area)
+        self.update_routing_table()
 
 
 if __name__ == '__main__':
-    _, nfe_ip, nfe_port, vrid = sys.argv
-    vr = VirtualRouter(nfe_ip, int(nfe_port), int(vrid))
+    parser = argparse.ArgumentParser(description="A virtual router")
+    parser.add_argument('nfe_ip')
+    parser.add_argument('nfe_port', type=int)
+    parser.add_argument('vrid', type=int)
+    parser.add_argument('--snapshot', action='store_true', help="write the full topology and routing table on every change instead of only the changed entries")
+    parser.add_argument('--flush-interval', type=float, default=1.0, help="seconds between file writes while LSAs keep arriving (default: 1.0)")
+    parser.add_argument('--refresh-interval', type=float, default=30.0, help="seconds between re-originations of this router's LSAs (default: 30)")
+    parser.add_argument('--max-age', type=float, default=90.0, help="seconds after which an LSA that wasn't refreshed is removed (default: 90)")
+    parser.add_argument('--single-lsa', action='store_true', help="send one LSA per message, like routers that don't know packed LSAs")
+    parser.add_argument('--idle-exit', type=float, metavar='MS', help="exit with status 0 once no new LSA arrived and the routing table "
+                                                                     "didn't change for MS milliseconds (default: run until killed)")
+    parser.add_argument('--timeout', type=float, help="exit with status 1 if not idle after this many seconds")
+    parser.add_argument('--engine', choices=['ls', 'dv'], default='ls', help="routing engine, link state or distance vector; "
+                                                                              "all routers of a topology have to run the same one (default: ls)")
+    parser.add_argument('--infinity', type=int, default=1024, help="dv: cost at which a destination is unreachable, "
+                                                                   "has to exceed the longest path (default: 1024)")
+    parser.add_argument('--trace', metavar='CATEGORIES', help="print a trace of these comma-separated categories, or 'all': "
+                                                              "{} (default: none)".format(', '.join(TRACE_CATEGORIES)))
+    parser.add_argument('--trace-level', choices=['debug', 'info'], default='debug',
+                        help="info only traces routing table and link changes (default: debug)")
+    args = parser.parse_args()
+    if args.trace:
+        categories = None if args.trace == 'all' else args.trace.split(',')
+        unknown = set(categories or ()) - set(TRACE_CATEGORIES)
+        if unknown:
+            parser.error("unknown trace categories: {}".format(', '.join(sorted(unknown))))
+        enable_trace(categories, args.trace_level.upper())
+    if args.max_age <= args.refresh_interval:
+        parser.error("--max-age has to be longer than --refresh-interval")
+    options = dict(snapshot=args.snapshot, flush_interval=args.flush_interval, refresh_interval=args.refresh_interval, max_age=args.max_age,
+                   idle_timeout=None if args.idle_exit is None else args.idle_exit / 1000, timeout=args.timeout)
+    if args.engine == 'dv':
+        from distancevector import DistanceVectorRouter
+        vr = DistanceVectorRouter(args.nfe_ip, args.nfe_port, args.vrid, infinity=args.infinity, **options)
+    else:
+        vr = VirtualRouter(args.nfe_ip, args.nfe_port, args.vrid, packed=not args.single_lsa, **options)
+    # killed routers still write out their files; SIGUSR1 dumps the counters to stderr
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: vr.dump_counters())
     vr.init()
-    vr.forward()
\ No newline at end of file
+    sys.exit(vr.forward())
\ No newline at end of file
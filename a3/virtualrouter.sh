@@ -1,3 +1,3 @@
 #!/bin/bash
 
-python3 virtualrouter.py $1 $2 $3
\ No newline at end of file
+python3 virtualrouter.py "$@"
\ No newline at end of file
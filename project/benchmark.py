@@ -0,0 +1,81 @@
+import dpkt
+import time
+import argparse
+from tls_flows import RECORD_TYPES, HANDSHAKE_TYPES, FlowTable, extract, flow_key
+from sources import open_capture
+
+
+# The extraction loop before the byte-level fast path: every packet parsed into dpkt objects,
+# and every TCP payload into TLS records and handshake messages
+def extract_dpkt(packets, table):
+    for ts, pkt in packets:
+        table.advance(ts)
+        eth = dpkt.ethernet.Ethernet(pkt)
+        if eth.type == dpkt.ethernet.ETH_TYPE_IP:
+            ip = eth.data
+            if ip.p == dpkt.ip.IP_PROTO_TCP:
+                tcp = ip.data
+                key, direction = flow_key(ip.src, ip.dst, tcp.sport, tcp.dport)
+                try:
+                    tls = dpkt.ssl.TLS(tcp.data)
+                    for record in tls.records:
+                        if record.type == RECORD_TYPES['TLSHandshake']:
+                            handshake = dpkt.ssl.TLSHandshake(record.data)
+                            if handshake.type == HANDSHAKE_TYPES['ClientHello']:
+                                table.start(ts, key, direction)
+                            elif handshake.type == HANDSHAKE_TYPES['ServerHello']:
+                                server_hello = handshake.data
+                                flow = table.flows.get(key)
+                                if hasattr(server_hello, 'extensions') and flow is not None and flow.client != direction:
+                                    for ext_name, ext_value in server_hello.extensions:
+                                        if ext_name == 16:
+                                            flow.set_application_layer_protocol(ext_value[3:].decode())
+                                            break
+                    flow = table.flows.get(key)
+                    table.add_packet(flow, ts, len(ip.data), flow is not None and flow.client == direction, tcp.flags)
+                except dpkt.NeedData:
+                    flow = table.flows.get(key)
+                    table.add_packet(flow, ts, len(ip.data), flow is not None and flow.client == direction, tcp.flags, counted=False)
+                except dpkt.ssl.SSL3Exception:
+                    pass
+    table.close()
+
+
+# Best time of some runs of an extraction loop, and the rows it writes
+def run(loop, capture, repeat):
+    best = None
+    for _ in range(repeat):
+        rows = []
+        table = FlowTable(lambda flow: rows.append(flow.to_row()) if flow.application_layer_protocol is not None else None)
+        source = open_capture(capture)
+        try:
+            start = time.perf_counter()
+            loop(source, table)
+            elapsed = time.perf_counter() - start
+        finally:
+            source.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Packets per second of tls_flows, with dpkt objects for every packet and with the fast path")
+    parser.add_argument('capture', help="a pcap or pcapng file")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each loop, the best one counts (default: 3)")
+    args = parser.parse_args()
+
+    source = open_capture(args.capture)
+    try:
+        start = time.perf_counter()
+        packets = sum(1 for _ in source)
+        read_time = time.perf_counter() - start
+    finally:
+        source.close()
+    print('{} packets, reading them takes {:.2f}s'.format(packets, read_time))
+
+    dpkt_time, dpkt_rows = run(extract_dpkt, args.capture, args.repeat)
+    fast_time, fast_rows = run(extract, args.capture, args.repeat)
+    print('dpkt objects: {:.2f}s, {:.0f} packets/s'.format(dpkt_time, packets / dpkt_time))
+    print('fast path:    {:.2f}s, {:.0f} packets/s, {:.1f}x'.format(fast_time, packets / fast_time, dpkt_time / fast_time))
+    # handshakes split across segments are only found with reassembly
+    print('flows with an ALPN: {} with dpkt objects, {} with the fast path'.format(len(dpkt_rows), len(fast_rows)))
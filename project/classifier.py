@@ -0,0 +1,111 @@
+import sys
+import time
+import pickle
+
+# Labels of the predictions of the models of flows.ipynb, trained with 0 for http/1.1 and 1 for h2; other models' are written as they are
+LABELS = ('http/1.1', 'h2')
+
+# Columns of the label stream: the flow, its label, the ALPN seen if any, and when it was classified: counted packets
+# and capture seconds since the start of the flow, then wall milliseconds from ready to predicted
+LABEL_FIELDS = (
+    ('src_ip', 'S39'),
+    ('dst_ip', 'S39'),
+    ('src_port', 'u2'),
+    ('dst_port', 'u2'),
+    ('label', 'S32'),
+    ('app_protocol', 'S32'),
+    ('packets', 'i8'),
+    ('decision_time', 'f8'),
+    ('latency_ms', 'f8')
+)
+
+
+# A model pickled from flows.ipynb. Pickles can run any code when loaded, only load trusted ones
+def load_model(path):
+    with open(path, 'rb') as fd:
+        return pickle.load(fd)
+
+
+# Classifies flows while a capture is extracted, with a model trained on Flow.vector: a flow is ready once `after` more
+# packets were counted after the one ending its ServerHello, or when it ends before that. Ready flows are predicted
+# in batches of batch_size, or sooner once the first one waited max_delay seconds, and a label row is written for each
+class OnlineClassifier:
+
+    def __init__(self, model, writer, after=10, batch_size=256, max_delay=0.05):
+        import numpy
+        self.numpy = numpy
+        self.model = model
+        self.writer = writer
+        self.after = after
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        # feature vectors of the ready flows, allocated for the size of the first one
+        self.batch = None
+        # (flow, packets, decision time, wall time it was ready) of the ready flows
+        self.ready = []
+        self.classified = 0
+        self.batches = 0
+        self.latency_total = 0
+        self.latency_max = 0
+
+    # A counted packet of a flow
+    def add_packet(self, flow):
+        if flow.classified or not flow.server_hello:
+            return
+        packets = flow.client_pck_count + flow.server_pck_count
+        if flow.classify_at is None:
+            flow.classify_at = packets + self.after
+        if packets >= flow.classify_at:
+            self.add(flow)
+
+    # A flow ended, it's classified with what it has if it wasn't yet
+    def end(self, flow):
+        if not flow.classified:
+            self.add(flow)
+
+    def add(self, flow):
+        flow.classified = True
+        vector = flow.vector()
+        if self.batch is None:
+            self.batch = self.numpy.empty((self.batch_size, len(vector)))
+        self.batch[len(self.ready)] = vector
+        self.ready.append((flow, flow.client_pck_count + flow.server_pck_count, max(flow.ts_end - flow.ts_start, 0),
+                           time.perf_counter()))
+        if len(self.ready) == self.batch_size:
+            self.predict()
+
+    # Called for every packet: predicts the ready flows if the first one waited long enough
+    def poll(self):
+        if self.ready and time.perf_counter() - self.ready[0][3] >= self.max_delay:
+            self.predict()
+
+    def predict(self):
+        labels = self.model.predict(self.batch[:len(self.ready)])
+        now = time.perf_counter()
+        for (flow, packets, decision_time, ready), label in zip(self.ready, labels):
+            latency = now - ready
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.writer.write(list(flow.endpoints()) + [
+                LABELS[label] if label in (0, 1) else label,
+                flow.application_layer_protocol or '',
+                packets,
+                decision_time,
+                latency * 1000
+            ])
+        self.writer.flush()
+        self.classified += len(self.ready)
+        self.batches += 1
+        self.ready = []
+
+    # The ready flows are predicted now, e.g. while no packets come in
+    def flush(self):
+        if self.ready:
+            self.predict()
+
+    # End of the input: the ready flows are predicted and a summary goes to stderr
+    def close(self):
+        self.flush()
+        if self.classified:
+            print('{} flows classified in {} batches, latency {:.3f} ms on average, {:.3f} ms at most'.format(
+                self.classified, self.batches, self.latency_total / self.classified * 1000, self.latency_max * 1000), file=sys.stderr)
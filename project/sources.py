@@ -0,0 +1,246 @@
+import os
+import abc
+import sys
+import time
+import select
+import socket
+import struct
+import itertools
+import threading
+import dpkt
+
+# Sources of captured Ethernet frames: pcap and pcapng files or pipes, and live AF_PACKET sockets.
+# A source is an iterable of (timestamp, frame bytes), read(count) gives them a batch at a time
+
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+# bytes asked for at least by every read of a pipe
+PIPE_READ = 1 << 16
+
+# Linux AF_PACKET: every protocol, packet type of frames sent by the host, loopback interfaces, and the drop counters
+ETH_P_ALL = 0x0003
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+TIMESPEC = struct.Struct('@qq')
+# frames are received whole up to this size, offloaded segments included
+MAX_FRAME = 1 << 18
+
+
+# What every source does; subclasses implement read, and close if they hold anything
+class PacketSource(abc.ABC):
+
+    # Up to count packets as soon as there is one, [] once the input ended
+    @abc.abstractmethod
+    def read(self, count):
+        pass
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            packets = self.read(256)
+            if not packets:
+                return
+            yield from packets
+
+
+# A file that can't seek, e.g. a pipe, read straight from its descriptor and buffered here, so it's known whether
+# more bytes are there without waiting
+class Pipe:
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.fd = fileobj.fileno()
+        self.buffer = b''
+        # next byte of the buffer to read
+        self.position = 0
+        self.eof = False
+
+    def fill(self, size):
+        chunks = [self.buffer[self.position:]]
+        available = len(chunks[0])
+        while available < size and not self.eof:
+            data = os.read(self.fd, max(size - available, PIPE_READ))
+            self.eof = not data
+            chunks.append(data)
+            available += len(data)
+        self.buffer = b''.join(chunks)
+        self.position = 0
+
+    def read(self, size):
+        if len(self.buffer) - self.position < size:
+            self.fill(size)
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def peek(self, size):
+        data = self.read(size)
+        self.position -= len(data)
+        return data
+
+    # Whether reading goes on without waiting for the writer
+    def ready(self):
+        return self.position < len(self.buffer) or self.eof or bool(select.select([self.fd], [], [], 0)[0])
+
+    def close(self):
+        self.fileobj.close()
+
+
+# A pcap or a pcapng capture, told apart by its first bytes, from a file or a pipe like `tcpdump -U -w -`.
+# From a pipe, read returns the packets that arrived so far rather than wait for count of them
+class CaptureSource(PacketSource):
+
+    def __init__(self, fileobj):
+        if fileobj.seekable():
+            head = fileobj.read(4)
+            fileobj.seek(0)
+            self.pipe = None
+        else:
+            fileobj = self.pipe = Pipe(fileobj)
+            head = fileobj.peek(4)
+        self.fileobj = fileobj
+        reader = dpkt.pcapng.Reader if head == PCAPNG_MAGIC else dpkt.pcap.Reader
+        self.packets = iter(reader(fileobj))
+
+    def read(self, count):
+        if self.pipe is None:
+            return list(itertools.islice(self.packets, count))
+        packets = []
+        for packet in self.packets:
+            packets.append(packet)
+            if len(packets) == count or not self.pipe.ready():
+                break
+        return packets
+
+    def close(self):
+        self.fileobj.close()
+
+    def __iter__(self):
+        return self.packets
+
+
+# The frames sent and received on a network interface, from a raw AF_PACKET socket: Linux only, and it needs
+# root or CAP_NET_RAW. Timestamps are the kernel's; the socket buffer is made large so bursts wait in it, and the
+# frames the kernel dropped anyway are reported when it's closed
+class AfPacketSource(PacketSource):
+
+    def __init__(self, interface, buffer_size=1 << 25):
+        self.interface = interface
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        self.sock.bind((interface, 0))
+        self.buffer = bytearray(MAX_FRAME)
+        self.view = memoryview(self.buffer)
+        self.ancillary_size = socket.CMSG_SPACE(TIMESPEC.size)
+
+    # The next frame, None if there is none yet and wait is False
+    def receive(self, wait):
+        while True:
+            try:
+                size, ancillary, flags, address = self.sock.recvmsg_into([self.buffer], self.ancillary_size,
+                                                                          0 if wait else socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return None
+            # a frame sent on a loopback interface is seen again as it's received
+            if address[2] == PACKET_OUTGOING and address[3] == ARPHRD_LOOPBACK:
+                continue
+            ts = None
+            for level, kind, data in ancillary:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                    seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                    ts = seconds + nanoseconds / 1e9
+            return (ts if ts is not None else time.time(), bytes(self.view[:size]))
+
+    def read(self, count):
+        packets = [self.receive(True)]
+        while len(packets) < count:
+            packet = self.receive(False)
+            if packet is None:
+                break
+            packets.append(packet)
+        return packets
+
+    def close(self):
+        received, dropped = struct.unpack('@II', self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+        if dropped:
+            print('{}: {} frames dropped by the kernel'.format(self.interface, dropped), file=sys.stderr)
+        self.sock.close()
+
+
+# Another source read by a thread into a ring buffer of slots batches, so a live capture or a pipe is drained while
+# the packets are parsed. The thread waits while every slot is full; an error it hits is raised once the batches before it were read.
+# idle is called when the parser caught up with the capture, before it waits for more packets
+class ThreadedSource(PacketSource):
+
+    def __init__(self, source, slots=64, batch=256, idle=None):
+        self.source = source
+        self.batch = batch
+        self.idle = idle
+        self.ring = [None] * slots
+        # next slot to read, and the number of slots filled
+        self.head = 0
+        self.filled = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                packets = self.source.read(self.batch)
+                with self.condition:
+                    while self.filled == len(self.ring) and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    if not packets:
+                        self.done = True
+                        self.condition.notify()
+                        return
+                    self.ring[(self.head + self.filled) % len(self.ring)] = packets
+                    self.filled += 1
+                    self.condition.notify()
+        except Exception as error:
+            with self.condition:
+                self.error = error
+                self.done = True
+                self.condition.notify()
+
+    # The next batch the thread read, whatever the count
+    def read(self, count):
+        if not self.filled and not self.done and self.idle is not None:
+            self.idle()
+        with self.condition:
+            while not self.filled and not self.done:
+                self.condition.wait()
+            if not self.filled:
+                if self.error is not None:
+                    raise self.error
+                return []
+            packets = self.ring[self.head]
+            self.ring[self.head] = None
+            self.head = (self.head + 1) % len(self.ring)
+            self.filled -= 1
+            self.condition.notify()
+            return packets
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.source.close()
+
+
+# The source of a capture file, or of stdin for '-'
+def open_capture(path):
+    if path == '-':
+        return CaptureSource(sys.stdin.buffer)
+    return CaptureSource(open(path, 'rb'))
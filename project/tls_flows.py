@@ -1,6 +1,20 @@
 import dpkt
 import socket
-import sys
+import os
+import array
+import bisect
+import struct
+import zlib
+import heapq
+import pickle
+import argparse
+import tempfile
+import collections
+import multiprocessing
+from writers import WRITERS
+from classifier import LABEL_FIELDS, OnlineClassifier, load_model
+from sources import AfPacketSource, ThreadedSource, open_capture
+from constants import PRETTY_NAMES
 
 HANDSHAKE_TYPES = {
     'HelloRequest': 0,
@@ -23,48 +37,183 @@ RECORD_TYPES = {
     'TLSAppData' : 23
 }
 
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+# 802.1Q and QinQ tags, up to two are skipped
+ETH_TYPES_VLAN = (0x8100, 0x88a8, 0x9100, 0x9200)
 
-def inv_key(key):
-     src_ip, dst_ip, src_port, dst_port = key
-     return (dst_ip, src_ip, dst_port, src_port)
+UINT16 = struct.Struct('!H')
+# IPv4 total length, flags and fragment offset, protocol
+IP_FIELDS = struct.Struct('!2xH2xHxB')
+# IPv6 extension headers skipped to get to TCP: hop-by-hop, routing and destination options, then fragment
+IP6_OPTIONS = (0, 43, 60)
+IP6_FRAGMENT = 44
+# TCP ports, sequence and acknowledgment numbers, data offset and flags
+TCP_FIELDS = struct.Struct('!HHIIH')
+
+# Handshake bytes kept at most for one direction of a flow, in messages not complete yet and segments after a gap
+HANDSHAKE_MAX = 1 << 16
+
+# Bins of the histograms of FlowFeatures: TCP segment sizes in bytes, times between the packets of one direction in seconds
+SIZE_EDGES = (64, 128, 256, 512, 1024, 1536)
+GAP_EDGES = (0.001, 0.01, 0.1, 1, 10)
+# and their names: below every edge, and at least the last one
+SIZE_BINS = ['lt{}'.format(edge) for edge in SIZE_EDGES] + ['ge{}'.format(SIZE_EDGES[-1])]
+GAP_BINS = ['lt{:g}ms'.format(edge * 1000) for edge in GAP_EDGES] + ['ge{:g}ms'.format(GAP_EDGES[-1] * 1000)]
+# Packet sizes and TLS record lengths kept from the start of a flow
+FIRST_PACKETS = 10
+FIRST_RECORDS = 10
+
+
+# A flow key packs both endpoints of a connection, address << 16 | port, into one int, the lower endpoint in the high bits,
+# and sets the IPV6_KEY bit for IPv6 addresses
+ENDPOINT_BITS = 144
+ENDPOINT_MASK = (1 << ENDPOINT_BITS) - 1
+IPV6_KEY = 1 << 2 * ENDPOINT_BITS
+
+
+# Key of the connection of a packet, the same in both directions, and the direction of the packet: 0 from the lower endpoint
+def flow_key(src_ip, dst_ip, src_port, dst_port):
+    src = int.from_bytes(src_ip, 'big') << 16 | src_port
+    dst = int.from_bytes(dst_ip, 'big') << 16 | dst_port
+    family = IPV6_KEY if len(src_ip) == 16 else 0
+    if src <= dst:
+        return family | src << ENDPOINT_BITS | dst, 0
+    return family | dst << ENDPOINT_BITS | src, 1
 
 
 class Flow:
+    # Columns of the output, the names the notebook uses, with their numpy types for the columnar outputs
+    FIELDS = (
+        ('src_ip', 'S39'),
+        ('dst_ip', 'S39'),
+        ('src_port', 'u2'),
+        ('dst_port', 'u2'),
+        ('cli_pkt_count', 'i8'),
+        ('cli_bytes', 'i8'),
+        ('avg_cli_pkt_size', 'f8'),
+        ('srv_pkt_count', 'i8'),
+        ('srv_bytes', 'i8'),
+        ('avg_srv_pkt_size', 'f8'),
+        ('flow_duration', 'f8'),
+        ('app_protocol', 'S32')
+    )
+
+    __slots__ = ('ts_start', 'ts_end', 'application_layer_protocol', 'server_hello', 'client_handshake', 'server_handshake',
+                 'client_hello_seq', 'key', 'client', 'client_pck_count', 'server_pck_count', 'client_bytes', 'server_bytes',
+                 'fin', 'rst', 'position', 'end_order', 'features', 'classify_at', 'classified')
 
-    def __init__(self, ts_start, key):
+    def __init__(self, ts_start, key, client, features=None):
         self.ts_start = ts_start
         self.ts_end = -1
         self.application_layer_protocol = None
+        # the handshake isn't parsed any further once the ServerHello is seen
+        self.server_hello = False
+        # reassembly of the ClientHello, and of the server's handshake up to the ServerHello
+        self.client_handshake = None
+        self.server_handshake = None
+        # sequence number of the segment the ClientHello starts in, a retransmission of it doesn't start another flow
+        self.client_hello_seq = None
+        # see flow_key, and the direction of the client's packets
         self.key = key
-        src_ip, dst_ip, src_port, dst_port = key
-        self.src_ip = src_ip
-        self.dst_ip = dst_ip
-        self.src_port = src_port
-        self.dst_port = dst_port
+        self.client = client
         self.client_pck_count = 0
         self.server_pck_count = 0
         self.client_bytes = 0
         self.server_bytes = 0
+        # FIN seen from the client (1) and from the server (2)
+        self.fin = 0
+        self.rst = False
+        # position in the flow table, and (packet, phase, position) when the flow ended, see FlowTable.end
+        self.position = 0
+        self.end_order = None
+        # FlowFeatures, if they are extracted
+        self.features = features
+        # counted packets at which an OnlineClassifier classifies the flow, and whether it did
+        self.classify_at = None
+        self.classified = False
 
-    def add_packet(self, ts, tcp_size, key):
-        if key == self.key:
+    def add_packet(self, ts, tcp_size, from_client, flags=0):
+        if self.features is not None:
+            self.features.add_packet(ts, tcp_size, from_client, self.client_pck_count + self.server_pck_count)
+        if from_client:
             self.client_pck_count += 1
             self.client_bytes += tcp_size
-        elif key == inv_key(self.key):
+        else:
             self.server_pck_count += 1
             self.server_bytes += tcp_size
+        self.add_flags(from_client, flags)
         
         self.ts_end = max(self.ts_end, ts)
 
+    # Follow FIN and RST, also of the segments without TLS records that aren't counted
+    def add_flags(self, from_client, flags):
+        if flags & dpkt.tcp.TH_FIN:
+            self.fin |= 1 if from_client else 2
+        if flags & dpkt.tcp.TH_RST:
+            self.rst = True
+
+    # Both ends sent a FIN, or one of them a RST
+    def closed(self):
+        return self.rst or self.fin == 3
+
+    # The payload pkt[start:end] of a segment in one direction, while its handshake is reassembled; returns the handshake
+    # messages it completes, None if it isn't reassembled. The server's handshake is followed from the acknowledgment number
+    # of the ClientHello, or else from its first handshake record
+    def reassemble(self, from_client, seq, pkt, start, end):
+        if from_client:
+            reassembler = self.client_handshake
+        else:
+            reassembler = self.server_handshake
+            if reassembler is None and not self.server_hello and pkt[start:start + 2] == b'\x16\x03':
+                reassembler = self.server_handshake = HandshakeReassembler(seq)
+        if reassembler is None or start == end:
+            return None
+        handshake = reassembler.messages is not None
+        messages = reassembler.add_segment(seq, pkt[start:end])
+        if reassembler.record_lengths:
+            if self.features is not None:
+                self.features.add_records(from_client, reassembler.record_lengths)
+            del reassembler.record_lengths[:]
+        if messages is None or not handshake and not self.features.wants_records():
+            # not TLS after all, too much to keep, or done with the record headers
+            self.stop_reassembly(from_client)
+        return messages if handshake else None
+
+    # The ClientHello or the ServerHello is complete: the reassembler of its direction only follows the record headers
+    # from now on while the features want more record lengths
+    def handshake_done(self, from_client):
+        if self.features is not None and self.features.wants_records():
+            reassembler = self.client_handshake if from_client else self.server_handshake
+            reassembler.messages = None
+        else:
+            self.stop_reassembly(from_client)
+
+    def stop_reassembly(self, from_client):
+        if from_client:
+            self.client_handshake = None
+        else:
+            self.server_handshake = None
+
     def set_application_layer_protocol(self, protocol):
         self.application_layer_protocol = protocol
-    
-    def to_row(self):
-        return ','.join(str(val) for val in [
-            self.src_ip,
-            self.dst_ip,
-            self.src_port,
-            self.dst_port,
+
+    # Addresses and ports of the client and the server, unpacked from the key only for the output
+    def endpoints(self):
+        low = self.key >> ENDPOINT_BITS & ENDPOINT_MASK
+        high = self.key & ENDPOINT_MASK
+        client, server = (low, high) if self.client == 0 else (high, low)
+        if self.key & IPV6_KEY:
+            src_ip = socket.inet_ntop(socket.AF_INET6, (client >> 16).to_bytes(16, 'big'))
+            dst_ip = socket.inet_ntop(socket.AF_INET6, (server >> 16).to_bytes(16, 'big'))
+        else:
+            src_ip = socket.inet_ntoa((client >> 16).to_bytes(4, 'big'))
+            dst_ip = socket.inet_ntoa((server >> 16).to_bytes(4, 'big'))
+        return src_ip, dst_ip, client & 0xffff, server & 0xffff
+
+    # Values of the FIELDS
+    def values(self):
+        return list(self.endpoints()) + [
             self.client_pck_count,
             self.client_bytes,
             self.client_bytes / self.client_pck_count,
@@ -73,68 +222,556 @@ class Flow:
             self.server_bytes / self.server_pck_count,
             self.ts_end - self.ts_start,
             self.application_layer_protocol
-        ])
+        ] + (self.features.values() if self.features is not None else [])
 
+    # Numbers of the flow so far for a model: the notebook's features, then the numbers of the FlowFeatures if any
+    def vector(self):
+        vector = [
+            self.client_pck_count,
+            self.client_bytes,
+            self.client_bytes / self.client_pck_count if self.client_pck_count else 0,
+            self.server_pck_count,
+            self.server_bytes,
+            self.server_bytes / self.server_pck_count if self.server_pck_count else 0,
+            max(self.ts_end - self.ts_start, 0)
+        ]
+        if self.features is not None:
+            vector += self.features.numbers()
+        return vector
 
-if __name__ == '__main__':
+    def to_row(self):
+        return ','.join(str(val) for val in self.values())
+
+
+# Handshake messages of one direction of a TCP connection, reassembled from its segments starting at sequence number seq,
+# which has to be the start of a TLS record. Only the bytes of handshake messages not complete yet are kept, with segments
+# that arrived after a gap until it is filled; other records are skipped as they go by, retransmitted bytes are dropped
+class HandshakeReassembler:
+
+    def __init__(self, seq):
+        self.next_seq = seq
+        # header of the current record as far as it arrived, and the bytes of the record still to come
+        self.header = b''
+        self.record_left = 0
+        # bytes of the handshake messages not complete yet, None once only the record headers are followed
+        self.messages = bytearray()
+        # lengths of the records whose header arrived, taken by the flow
+        self.record_lengths = []
+        # segments after a gap by sequence number
+        self.pending = {}
+        self.pending_size = 0
+
+    # A segment; returns the handshake messages it completes, each with its 4 byte header, None once the bytes
+    # aren't TLS records or more than HANDSHAKE_MAX bytes would be kept
+    def add_segment(self, seq, payload):
+        if seq in self.pending:
+            self.pending_size -= len(self.pending[seq])
+        self.pending[seq] = payload
+        self.pending_size += len(payload)
+        messages = []
+        while True:
+            # a segment starting at or before the next byte, in sequence number arithmetic
+            ready = [seq for seq in self.pending if (self.next_seq - seq) & 0xffffffff < 1 << 31]
+            if not ready:
+                break
+            payload = self.pending.pop(ready[0])
+            self.pending_size -= len(payload)
+            if not self.add_bytes(payload[(self.next_seq - ready[0]) & 0xffffffff:], messages):
+                return None
+        if len(self.messages or b'') + self.pending_size > HANDSHAKE_MAX:
+            return None
+        return messages
+
+    # The next bytes of the stream
+    def add_bytes(self, data, messages):
+        self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+        position = 0
+        while position < len(data):
+            if len(self.header) < 5:
+                taken = data[position:position + 5 - len(self.header)]
+                self.header += taken
+                position += len(taken)
+                if len(self.header) < 5:
+                    break
+                if self.header[0] < RECORD_TYPES['TLSChangeCipherSpec'] or self.header[0] > RECORD_TYPES['TLSAppData'] or self.header[1] != 3:
+                    return False
+                self.record_left = UINT16.unpack_from(self.header, 3)[0]
+                self.record_lengths.append(self.record_left)
+            else:
+                taken = min(self.record_left, len(data) - position)
+                if self.header[0] == RECORD_TYPES['TLSHandshake'] and self.messages is not None:
+                    self.messages += data[position:position + taken]
+                position += taken
+                self.record_left -= taken
+            if self.record_left == 0:
+                self.header = b''
+        while self.messages is not None and len(self.messages) >= 4:
+            length = 4 + int.from_bytes(self.messages[1:4], 'big')
+            if len(self.messages) < length:
+                break
+            messages.append(bytes(self.messages[:length]))
+            del self.messages[:length]
+        return True
+
+
+# Name of a cipher suite or a TLS extension, its number if there is none
+def pretty_name(kind, number):
+    name = PRETTY_NAMES[kind].get(number)
+    if name is None:
+        return hex(number) if kind == 'cipher_suites' else str(number)
+    return name.strip()
+
+
+# Features of a flow for the classifier beyond the counts, kept in buffers of a fixed size while it goes on:
+# histograms of the segment sizes and of the times between segments per direction, the sizes of the first segments
+# and the lengths of the first TLS records, positive from the client and negative from the server; and from the hellos
+# the cipher suite, the server name and the extensions. Segments are the ones counted in the packet counts
+class FlowFeatures:
+    __slots__ = ('sizes', 'gaps', 'client_ts', 'server_ts', 'first_packets', 'first_records', 'record_count',
+                 'cipher_suite', 'server_name', 'client_extensions', 'server_extensions')
+
+    FIELDS = tuple(
+        [('{}_size_{}'.format(side, name), 'i8') for side in ('cli', 'srv') for name in SIZE_BINS] +
+        [('{}_gap_{}'.format(side, name), 'i8') for side in ('cli', 'srv') for name in GAP_BINS] +
+        [('pkt_size_{}'.format(i), 'i4') for i in range(FIRST_PACKETS)] +
+        [('record_len_{}'.format(i), 'i4') for i in range(FIRST_RECORDS)] +
+        [('cipher_suite', 'S64'), ('server_name', 'S253'), ('cli_extensions', 'S512'), ('srv_extensions', 'S512')]
+    )
+
+    def __init__(self):
+        # client bins, then server bins
+        self.sizes = array.array('l', [0]) * (2 * len(SIZE_BINS))
+        self.gaps = array.array('l', [0]) * (2 * len(GAP_BINS))
+        self.client_ts = None
+        self.server_ts = None
+        self.first_packets = array.array('l', [0]) * FIRST_PACKETS
+        self.first_records = array.array('l', [0]) * FIRST_RECORDS
+        self.record_count = 0
+        self.cipher_suite = ''
+        self.server_name = ''
+        self.client_extensions = ''
+        self.server_extensions = ''
+
+    # A counted segment, index of them in the flow
+    def add_packet(self, ts, tcp_size, from_client, index):
+        side = 0 if from_client else 1
+        self.sizes[side * len(SIZE_BINS) + bisect.bisect_right(SIZE_EDGES, tcp_size)] += 1
+        last_ts = self.client_ts if from_client else self.server_ts
+        if last_ts is not None:
+            self.gaps[side * len(GAP_BINS) + bisect.bisect_right(GAP_EDGES, ts - last_ts)] += 1
+        if from_client:
+            self.client_ts = ts
+        else:
+            self.server_ts = ts
+        if index < FIRST_PACKETS:
+            self.first_packets[index] = tcp_size if from_client else -tcp_size
+
+    def wants_records(self):
+        return self.record_count < FIRST_RECORDS
+
+    def add_records(self, from_client, lengths):
+        for length in lengths[:FIRST_RECORDS - self.record_count]:
+            self.first_records[self.record_count] = length if from_client else -length
+            self.record_count += 1
+
+    def add_client_hello(self, client_hello):
+        extensions = getattr(client_hello, 'extensions', [])
+        self.client_extensions = ';'.join(pretty_name('extension_type', ext_type) for ext_type, ext_value in extensions)
+        for ext_type, ext_value in extensions:
+            # a list of names, the first one a host name: list length, name type, name length
+            if ext_type == 0 and len(ext_value) >= 5:
+                self.server_name = ext_value[5:5 + UINT16.unpack_from(ext_value, 3)[0]].decode('ascii', 'backslashreplace')
+
+    def add_server_hello(self, server_hello):
+        self.cipher_suite = pretty_name('cipher_suites', server_hello.ciphersuite.code)
+        extensions = getattr(server_hello, 'extensions', [])
+        self.server_extensions = ';'.join(pretty_name('extension_type', ext_type) for ext_type, ext_value in extensions)
+
+    # Values of the numeric FIELDS, in order
+    def numbers(self):
+        return list(self.sizes) + list(self.gaps) + list(self.first_packets) + list(self.first_records)
+
+    # Values of the FIELDS
+    def values(self):
+        return self.numbers() + [
+            self.cipher_suite,
+            self.server_name,
+            self.client_extensions,
+            self.server_extensions
+        ]
 
-    _, pcapng = sys.argv
-
-    flows = []
-    flows_temp = {}
-
-    for ts, pkt in dpkt.pcapng.Reader(open(pcapng,'rb')):
-        eth = dpkt.ethernet.Ethernet(pkt)
-        if eth.type == dpkt.ethernet.ETH_TYPE_IP:
-            ip = eth.data
-            src_ip = socket.inet_ntoa(ip.src)
-            dst_ip = socket.inet_ntoa(ip.dst)
-            if ip.p == dpkt.ip.IP_PROTO_TCP:
-                tcp = ip.data
-                src_port = tcp.sport
-                dst_port = tcp.dport
-                
-                # 4 tuple because we know it is TCP
-                key = (src_ip, dst_ip, src_port, dst_port) 
-                stream = tcp.data
+
+# Flows of a capture by their key; a finished flow is passed to emit
+#   batch mode:  flows end when the client starts a new flow with the same key, or at the end of the capture
+#   stream mode: flows also end on FIN/RST, after idle_timeout seconds of capture time without a packet,
+#                or when more than max_flows are open, the least recently active one first
+# An OnlineClassifier sees the counted packets of the flows, and gets a chance to predict at every packet
+class FlowTable:
+
+    def __init__(self, emit, stream=False, idle_timeout=120, max_flows=100000, features=False, classifier=None):
+        self.emit = emit
+        self.stream = stream
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        # extract FlowFeatures of every flow
+        self.features = features
+        self.classifier = classifier
+        # least recently active first in stream mode, oldest first in batch mode
+        self.flows = collections.OrderedDict()
+        self.now = 0
+        # packets of the capture so far, the current one included
+        self.packets = 0
+
+    # A ClientHello from the client, direction of its packets in the key
+    def start(self, ts, key, client):
+        flow = Flow(ts, key, client, FlowFeatures() if self.features else None)
+        flow.position = self.packets
+        old = self.flows.get(key)
+        if old is not None:
+            if not self.stream:
+                flow.position = old.position # takes the place of the old flow
+            self.end(old, 1)
+        self.flows[key] = flow
+        if self.stream:
+            self.flows.move_to_end(key)
+            if len(self.flows) > self.max_flows:
+                self.end(self.flows.popitem(last=False)[1], 1)
+        return flow
+
+    # A packet of a flow; one that isn't counted, e.g. an empty ACK or FIN, can still end the flow in stream mode
+    def add_packet(self, flow, ts, tcp_size, from_client, flags, counted=True):
+        if flow is None:
+            return
+        if counted:
+            flow.add_packet(ts, tcp_size, from_client, flags)
+            if self.classifier is not None:
+                self.classifier.add_packet(flow)
+        else:
+            flow.add_flags(from_client, flags)
+        if not self.stream:
+            return
+        if flow.closed():
+            del self.flows[flow.key]
+            self.end(flow, 1)
+        elif counted:
+            self.flows.move_to_end(flow.key)
+            flow.position = self.packets
+
+    # Next packet, at capture time ts: end the flows idle for too long
+    def advance(self, ts):
+        self.packets += 1
+        self.now = max(self.now, ts)
+        if self.classifier is not None:
+            self.classifier.poll()
+        if not self.stream:
+            return
+        while self.flows:
+            flow = next(iter(self.flows.values()))
+            if self.now - max(flow.ts_start, flow.ts_end) < self.idle_timeout:
+                break
+            self.flows.popitem(last=False)
+            self.end(flow, 0)
+
+    # End of the capture, every open flow ends
+    def close(self):
+        self.packets += 1
+        while self.flows:
+            self.end(self.flows.popitem(last=False)[1], 0)
+
+    # A serial run ends flows in the order of the packet that ended them; at one packet, the idle flows (phase 0)
+    # in table order first, then the flow of the packet itself (phase 1). Parallel runs merge their output in that order
+    def end(self, flow, phase):
+        flow.end_order = (self.packets, phase, flow.position)
+        self.emit(flow)
+
+
+# Parse the headers of an IPv4 or IPv6 TCP packet in an Ethernet frame straight from its bytes, VLAN tags skipped. Returns the
+# addresses, ports, size of the TCP segment (header included), sequence and acknowledgment numbers, flags and where its payload
+# starts and ends in pkt; None for other packets, fragments after the first and broken headers
+def tcp_segment(pkt):
+    if len(pkt) < 14:
+        return None
+    eth_type = UINT16.unpack_from(pkt, 12)[0]
+    offset = 14
+    if eth_type in ETH_TYPES_VLAN and len(pkt) >= 18:
+        eth_type = UINT16.unpack_from(pkt, 16)[0]
+        offset = 18
+        if eth_type == 0x8100 and len(pkt) >= 22:
+            eth_type = UINT16.unpack_from(pkt, 20)[0]
+            offset = 22
+    if eth_type == ETH_TYPE_IP and len(pkt) >= offset + 20:
+        ip_len, fragment, protocol = IP_FIELDS.unpack_from(pkt, offset)
+        header_len = (pkt[offset] & 0x0f) * 4
+        if protocol != dpkt.ip.IP_PROTO_TCP or fragment & 0x1fff or header_len < 20:
+            return None
+        src_ip = pkt[offset + 12:offset + 16]
+        dst_ip = pkt[offset + 16:offset + 20]
+        tcp = offset + header_len
+        # a length of 0 is left by TCP segmentation offload, the segment takes the rest of the frame
+        end = min(offset + ip_len, len(pkt)) if ip_len else len(pkt)
+    elif eth_type == ETH_TYPE_IP6 and len(pkt) >= offset + 40:
+        payload_len = UINT16.unpack_from(pkt, offset + 4)[0]
+        next_header = pkt[offset + 6]
+        src_ip = pkt[offset + 8:offset + 24]
+        dst_ip = pkt[offset + 24:offset + 40]
+        tcp = offset + 40
+        end = min(tcp + payload_len, len(pkt)) if payload_len else len(pkt)
+        while next_header != dpkt.ip.IP_PROTO_TCP:
+            if tcp + 8 > end:
+                return None
+            if next_header == IP6_FRAGMENT:
+                if UINT16.unpack_from(pkt, tcp + 2)[0] & 0xfff8:
+                    return None
+                header_len = 8
+            elif next_header in IP6_OPTIONS:
+                header_len = (pkt[tcp + 1] + 1) * 8
+            else:
+                return None
+            next_header = pkt[tcp]
+            tcp += header_len
+    else:
+        return None
+    if end - tcp < 20:
+        return None
+    src_port, dst_port, seq, ack, offset_flags = TCP_FIELDS.unpack_from(pkt, tcp)
+    data_offset = (offset_flags >> 12) * 4
+    if data_offset < 20:
+        return None
+    return src_ip, dst_ip, src_port, dst_port, end - tcp, seq, ack, offset_flags & 0x1ff, min(tcp + data_offset, end), end
+
+
+# The TLS records of the payload pkt[start:end], from their headers only: (type, start, end) of their data in pkt.
+# Records follow each other from the start of the payload like in dpkt.ssl.TLS, which ignores up to 5 trailing bytes.
+# None if the payload doesn't start with whole records: too short, a record cut short, or a header that isn't TLS
+def tls_records(pkt, start, end):
+    if end - start < 5:
+        return None
+    records = []
+    while end - start > 5:
+        record_type = pkt[start]
+        if record_type < RECORD_TYPES['TLSChangeCipherSpec'] or record_type > RECORD_TYPES['TLSAppData'] or pkt[start + 1] != 3:
+            return None
+        record_end = start + 5 + UINT16.unpack_from(pkt, start + 3)[0]
+        records.append((record_type, start + 5, record_end))
+        start = record_end
+    if start > end:
+        return None
+    return records
+
+
+# Whether the payload pkt[start:end] starts with a handshake record holding a ClientHello, which starts a flow
+def starts_client_hello(pkt, start, end):
+    return (end - start >= 6 and pkt[start] == RECORD_TYPES['TLSHandshake'] and pkt[start + 1] == 3
+            and pkt[start + 5] == HANDSHAKE_TYPES['ClientHello'])
+
+
+# Which of count parts of a capture the flow with this key belongs to, from the 289 bits of the key
+def packet_part(key, count):
+    return zlib.crc32(key.to_bytes(37, 'big')) % count
+
+
+# Extract the flows of a capture, (timestamp, Ethernet frame) pairs like a PacketSource, into table;
+# with part = (index, count), only the flows of that part.
+# Headers and TLS records are read from the raw bytes. A flow starts with the first segment of a ClientHello, and its
+# handshake is reassembled across segments until the ServerHello, which dpkt parses for the ALPN; later handshake
+# messages are encrypted and not looked at
+def extract(packets, table, part=None):
+    for ts, pkt in packets:
+        table.advance(ts)
+        segment = tcp_segment(pkt)
+        if segment is None:
+            continue
+        src_ip, dst_ip, src_port, dst_port, tcp_size, seq, ack, flags, start, end = segment
+        key, direction = flow_key(src_ip, dst_ip, src_port, dst_port)
+        if part is not None and packet_part(key, part[1]) != part[0]:
+            continue
+
+        flow = table.flows.get(key)
+        if starts_client_hello(pkt, start, end) and (flow is None or flow.client == direction and flow.client_hello_seq != seq):
+            flow = table.start(ts, key, direction)
+            flow.client_hello_seq = seq
+            flow.client_handshake = HandshakeReassembler(seq)
+            if flags & dpkt.tcp.TH_ACK:
+                # the server's stream starts at what the client acknowledges, its segments can come in any order
+                flow.server_handshake = HandshakeReassembler(ack)
+        if flow is None:
+            continue
+
+        from_client = flow.client == direction
+        messages = flow.reassemble(from_client, seq, pkt, start, end)
+        for message in messages or ():
+            if message[0] == HANDSHAKE_TYPES['ClientHello'] and from_client:
+                flow.handshake_done(True)
+                if flow.features is not None:
+                    try:
+                        flow.features.add_client_hello(dpkt.ssl.TLSHandshake(message).data)
+                    except (dpkt.UnpackError, dpkt.ssl.SSL3Exception):
+                        pass
+                break
+
+            elif message[0] == HANDSHAKE_TYPES['ServerHello'] and not from_client:
+                flow.server_hello = True
+                flow.handshake_done(False)
                 try:
-                    tls = dpkt.ssl.TLS(stream)
-                    for record in tls.records:
-                        if record.type == RECORD_TYPES['TLSHandshake']:
-                            handshake = dpkt.ssl.TLSHandshake(record.data)
-                            if handshake.type == HANDSHAKE_TYPES['ClientHello']:
-
-                                if key in flows_temp:
-                                    flows.append(flows_temp[key])
-                                flows_temp[key] = Flow(ts, key)
-
-                            elif handshake.type == HANDSHAKE_TYPES['ServerHello']:
-                                server_hello = handshake.data
-
-                                if hasattr(server_hello, 'extensions'):
-                                    for ext_name, ext_value in server_hello.extensions:
-                                        if ext_name == 16:
-                                            alpn = ext_value[3:]
-                                            if inv_key(key) in flows_temp:
-                                                flows_temp[inv_key(key)].set_application_layer_protocol(alpn.decode())
-                                                break
-
-                    if key in flows_temp:
-                        flows_temp[key].add_packet(ts, len(ip.data), key)
-                    elif inv_key(key) in flows_temp:
-                        flows_temp[inv_key(key)].add_packet(ts, len(ip.data), key)
-
-                except dpkt.NeedData:
-                    pass
-                except dpkt.ssl.SSL3Exception:
-                    pass
-                except Exception as e:
-                    raise e
-
-
-    for key, flow in flows_temp.items():
-        flows.append(flow)
-
-    for flow in flows:
-        if flow.application_layer_protocol is not None:
-            print(flow.to_row())
\ No newline at end of file
+                    server_hello = dpkt.ssl.TLSHandshake(message).data
+                except (dpkt.UnpackError, dpkt.ssl.SSL3Exception):
+                    break
+                if flow.features is not None:
+                    flow.features.add_server_hello(server_hello)
+
+                if hasattr(server_hello, 'extensions'):
+                    for ext_name, ext_value in server_hello.extensions:
+                        if ext_name == 16:
+                            alpn = ext_value[3:]
+                            flow.set_application_layer_protocol(alpn.decode())
+                            break
+                break
+
+        # segments of whole TLS records and of the handshake are counted; empty ACKs and the middle of
+        # other records aren't, but a FIN or RST can end the flow
+        if messages is not None or tls_records(pkt, start, end) is not None:
+            table.add_packet(flow, ts, tcp_size, from_client, flags)
+        elif flags & (dpkt.tcp.TH_FIN | dpkt.tcp.TH_RST):
+            table.add_packet(flow, ts, tcp_size, from_client, flags, counted=False)
+    table.close()
+
+
+# The captures to extract: a file or stdin, or every pcap and pcapng file of a directory in name order
+def capture_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(('.pcap', '.pcapng')))
+
+
+# Worker process: extract a capture, or one part of it, into a temporary file and return its path.
+# It holds the order every flow with an ALPN ended in and its values, pickled one flow after the other
+def extract_to_file(job):
+    capture, options = job[:2]
+    fd, path = tempfile.mkstemp(prefix='tls-flows-')
+    with os.fdopen(fd, 'wb') as out:
+        def emit(flow):
+            if flow.application_layer_protocol is not None:
+                pickle.dump((flow.end_order, flow.values()), out)
+        source = open_capture(capture)
+        extract(source, FlowTable(emit, **options), job[2])
+        source.close()
+    return path
+
+
+# The (order, values) of the flows in the output of a worker; it's removed once read
+def read_file(path):
+    with open(path, 'rb') as fd:
+        while True:
+            try:
+                yield pickle.load(fd)
+            except EOFError:
+                break
+    os.remove(path)
+
+
+# With several captures every worker extracts whole captures, written in capture order; with a single one
+# every worker extracts the flows of one part of it, hashed by their addresses and ports, merged into the order of a serial run
+def extract_parallel(captures, options, workers, writer):
+    with multiprocessing.Pool(workers) as pool:
+        if len(captures) > 1:
+            for path in pool.imap(extract_to_file, [(capture, options, None) for capture in captures]):
+                for order, values in read_file(path):
+                    writer.write(values)
+        else:
+            paths = pool.map(extract_to_file, [(captures[0], options, (index, workers)) for index in range(workers)])
+            for order, values in heapq.merge(*(read_file(path) for path in paths), key=lambda record: record[0]):
+                writer.write(values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract TLS flows from a pcap or pcapng capture, a directory of them, stdin "
+                                                 "or a network interface, as CSV rows or columns")
+    parser.add_argument('capture', nargs='?',
+                        help="a pcap or pcapng file, a directory whose captures are extracted one after the other, or - for stdin")
+    parser.add_argument('--interface', '-i',
+                        help="capture live from this network interface instead, until interrupted (Linux, root or CAP_NET_RAW)")
+    parser.add_argument('--stream', action='store_true',
+                        help="write flows as they end (FIN/RST, idle, evicted) instead of at the end of the capture, in bounded memory")
+    parser.add_argument('--idle-timeout', type=float, default=120,
+                        help="--stream: seconds of capture time without a packet after which a flow ends (default: 120)")
+    parser.add_argument('--max-flows', type=int, default=100000,
+                        help="--stream: open flows kept at most, the least recently active one ends first (default: 100000)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes, splitting the captures of a directory, or the flows of one capture; "
+                             "with --stream each worker keeps up to --max-flows flows (default: 1)")
+    parser.add_argument('--features', action='store_true',
+                        help="add histograms of segment sizes and times between segments, the first segment sizes and record lengths, "
+                             "the cipher suite, server name and extensions of every flow")
+    parser.add_argument('--model',
+                        help="a model pickled from flows.ipynb, trained on its features and then the numbers of --features if given: "
+                             "classify flows while extracting and write a label stream instead of the flows (only load trusted pickles)")
+    parser.add_argument('--classify-after', type=int, default=10,
+                        help="--model: packets counted after the ServerHello before a flow is classified, "
+                             "flows ending earlier are classified at their end (default: 10)")
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help="--model: flows predicted at once (default: 256)")
+    parser.add_argument('--max-delay', type=float, default=0.05,
+                        help="--model: seconds a ready flow waits at most for its batch to fill (default: 0.05)")
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv',
+                        help="csv rows; npy, a directory with a .npy file per column (numpy); or a parquet file (pyarrow) (default: csv)")
+    parser.add_argument('--output', '-o',
+                        help="file, or directory for npy, to write to; csv goes to stdout without it")
+    parser.add_argument('--chunk-rows', type=int, default=65536,
+                        help="npy, parquet: flows gathered in memory before they are written (default: 65536)")
+    args = parser.parse_args()
+    if args.format != 'csv' and args.output is None:
+        parser.error('--format {} needs --output'.format(args.format))
+    if (args.capture is None) == (args.interface is None):
+        parser.error('give a capture or --interface')
+    if args.workers > 1 and (args.interface is not None or args.capture == '-'):
+        parser.error('--workers needs capture files')
+    if args.model is not None and (args.format != 'csv' or args.workers > 1):
+        parser.error('--model writes csv labels in one process')
+
+    options = {'stream': args.stream, 'idle_timeout': args.idle_timeout, 'max_flows': args.max_flows, 'features': args.features}
+    fields = Flow.FIELDS + FlowFeatures.FIELDS if args.features else Flow.FIELDS
+    classifier = None
+    if args.model is not None:
+        writer = WRITERS[args.format](args.output, LABEL_FIELDS)
+        classifier = options['classifier'] = OnlineClassifier(load_model(args.model), writer, args.classify_after,
+                                                              args.batch_size, args.max_delay)
+    else:
+        writer = WRITERS[args.format](args.output, fields, args.chunk_rows)
+
+    def emit(flow):
+        if classifier is not None:
+            classifier.end(flow)
+        elif flow.application_layer_protocol is not None:
+            writer.write(flow.values())
+
+    # Whenever a live capture or a pipe has no packets waiting, the flows ready so far are labeled or written out
+    def idle():
+        if classifier is not None:
+            classifier.flush()
+        elif args.format == 'csv':
+            writer.flush()
+
+    # a live capture or a pipe is read by a thread, so it's drained while the packets are parsed
+    def open_source(capture):
+        if capture is None:
+            return ThreadedSource(AfPacketSource(args.interface), idle=idle)
+        if capture == '-':
+            return ThreadedSource(open_capture(capture), idle=idle)
+        return open_capture(capture)
+
+    if args.workers > 1:
+        extract_parallel(capture_files(args.capture), options, args.workers, writer)
+    else:
+        for capture in [None] if args.capture is None else capture_files(args.capture):
+            source = open_source(capture)
+            table = FlowTable(emit, **options)
+            try:
+                extract(source, table)
+            except KeyboardInterrupt:
+                # a live capture runs until interrupted, the flows still open end then
+                table.close()
+            finally:
+                source.close()
+    if classifier is not None:
+        classifier.close()
+    writer.close()
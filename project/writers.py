@@ -0,0 +1,115 @@
+import os
+import sys
+import struct
+
+# Writers of flow features, one row of values at a time. Fields are (name, numpy type) pairs, like Flow.FIELDS;
+# the columnar writers need numpy, and pyarrow for Parquet, the CSV writer neither
+
+
+# Rows as CSV lines, without a header, to a file or stdout
+class CsvWriter:
+
+    def __init__(self, path, fields, chunk_rows=None):
+        self.out = sys.stdout if path is None or path == '-' else open(path, 'w')
+
+    def write(self, values):
+        self.out.write(','.join(str(val) for val in values) + '\n')
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        if self.out is sys.stdout:
+            self.out.flush()
+        else:
+            self.out.close()
+
+
+# Rows gathered column by column into typed numpy arrays of chunk_rows values, handed to write_chunk once full.
+# Text columns are ASCII bytes of fixed width, longer values are cut
+class ColumnWriter:
+
+    def __init__(self, path, fields, chunk_rows=65536):
+        import numpy
+        self.path = path
+        self.fields = fields
+        self.columns = [numpy.empty(chunk_rows, dtype) for name, dtype in fields]
+        self.rows = 0
+
+    def write(self, values):
+        for column, value in zip(self.columns, values):
+            column[self.rows] = value
+        self.rows += 1
+        if self.rows == len(self.columns[0]):
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write_chunk([column[:self.rows] for column in self.columns])
+            self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.finish()
+
+
+# Size of the header of the .npy files, the same for any number of rows so it can be written again at the end
+NPY_HEADER_SIZE = 128
+
+
+# A directory with a .npy file per column, appended to chunk by chunk, to be loaded with numpy.load(mmap_mode='r')
+class NpyWriter(ColumnWriter):
+
+    def __init__(self, path, fields, chunk_rows=65536):
+        super().__init__(path, fields, chunk_rows)
+        os.makedirs(path, exist_ok=True)
+        self.files = [open(os.path.join(path, name + '.npy'), 'wb') for name, dtype in fields]
+        self.total = 0
+        for fd, column in zip(self.files, self.columns):
+            fd.write(self.header(column.dtype, 0))
+
+    # Header of format version 1.0 for a column of rows values, padded with spaces to NPY_HEADER_SIZE
+    def header(self, dtype, rows):
+        text = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(dtype.str, rows)
+        text = text.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(text)) + text.encode('latin1')
+
+    def write_chunk(self, columns):
+        for fd, column in zip(self.files, columns):
+            fd.write(column.tobytes())
+        self.total += len(columns[0])
+
+    def finish(self):
+        for fd, column in zip(self.files, self.columns):
+            fd.seek(0)
+            fd.write(self.header(column.dtype, self.total))
+            fd.close()
+
+
+# A Parquet file, with a row group per chunk
+class ParquetWriter(ColumnWriter):
+
+    def __init__(self, path, fields, chunk_rows=65536):
+        import pyarrow
+        import pyarrow.parquet
+        super().__init__(path, fields, chunk_rows)
+        self.pyarrow = pyarrow
+        self.types = [pyarrow.string() if column.dtype.kind == 'S' else pyarrow.from_numpy_dtype(column.dtype)
+                      for column in self.columns]
+        self.schema = pyarrow.schema([(name, type) for (name, dtype), type in zip(fields, self.types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_chunk(self, columns):
+        arrays = [self.pyarrow.array(column, type=self.pyarrow.binary()).cast(type) if column.dtype.kind == 'S'
+                  else self.pyarrow.array(column, type=type) for column, type in zip(columns, self.types)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def finish(self):
+        self.writer.close()
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'npy': NpyWriter,
+    'parquet': ParquetWriter
+}